@@ -0,0 +1,47 @@
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from follow.models import Follow
+
+from mezzanine.blog.models import BlogPost
+
+
+# Number of blog post IDs given to each update query.
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    """
+    Sets ``BlogPost.followers_count`` for every blog post from the
+    follows stored for it. The count is kept current as blog posts are
+    followed and unfollowed, so this only needs to be run when the
+    field is first added, or if follows have been changed without
+    signals being sent.
+    """
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        verbosity = int(options.get("verbosity", 1))
+        follows = Follow.objects.filter(target_blogpost__isnull=False)
+        counts = follows.values("target_blogpost").annotate(Count("id"))
+        # Group the blog posts by their count, so that each distinct
+        # count is stored with as few updates as possible.
+        blog_post_ids = {}
+        for follow in counts:
+            count = follow["id__count"]
+            blog_post_ids.setdefault(count, []).append(
+                follow["target_blogpost"])
+        blog_posts = BlogPost._base_manager.all()
+        followed = follows.values("target_blogpost")
+        blog_posts.exclude(id__in=followed).update(followers_count=0)
+        total = 0
+        for (count, ids) in blog_post_ids.items():
+            total += len(ids)
+            for i in range(0, len(ids), BATCH_SIZE):
+                batch = blog_posts.filter(id__in=ids[i:i + BATCH_SIZE])
+                batch.update(followers_count=count)
+        if verbosity >= 1:
+            self.stdout.write("Updated followers count for %s followed "
+                              "blog posts\n" % total)
@@ -0,0 +1,22 @@
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from mezzanine.blog.models import BlogPost
+
+
+class Command(BaseCommand):
+    """
+    Sets ``BlogPost.ranking_score`` for every blog post from its
+    rating averages. The score is kept current as reviews are saved
+    and deleted, so this only needs to be run when the field is first
+    added.
+    """
+
+    def handle(self, *args, **options):
+        score = (F("price_average") + F("website_ex_average") +
+                 F("quality_average") + F("service_average"))
+        updated = BlogPost._base_manager.update(ranking_score=score)
+        if int(options.get("verbosity", 1)) >= 1:
+            self.stdout.write("Updated ranking score for %s blog posts\n" %
+                              updated)
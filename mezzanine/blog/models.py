@@ -1,14 +1,21 @@
+from django.contrib.contenttypes.models import ContentType
+from collections import namedtuple
+
+from django.core.urlresolvers import NoReverseMatch, reverse
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_delete, post_save
 
 from mezzanine.conf import settings
 from mezzanine.core.fields import FileField
 from mezzanine.core.models import Displayable, Ownable, RichText, Slugged, UniqueSlugged
+from mezzanine.core.search import typeahead_categories_changed
 from mezzanine.generic.fields import CommentsField, RatingField, ReviewsField, RequiredReviewRatingField, OptionalReviewRatingField
 from mezzanine.utils.models import AdminThumbMixin, upload_to
 from django.db import models
 from follow import utils
+from follow.models import Follow
 from actstream import actions
 
 class BlogPost(Displayable, Ownable, RichText, AdminThumbMixin):
@@ -36,11 +43,15 @@ class BlogPost(Displayable, Ownable, RichText, AdminThumbMixin):
     admin_thumb_field = "featured_image"
     num_images    = models.PositiveIntegerField(verbose_name="Photos Uploaded", default=0)
     web_url = models.URLField(verify_exists=True, max_length=200, null=True, blank=True)
+    followers_count = models.IntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _("Blog post")
         verbose_name_plural = _("Blog posts")
         ordering = ("-publish_date",)
+        # The index on (site, status, overall_average, ranking_score)
+        # for the vendor listings is created by sql/blogpost.sql, as
+        # Django 1.4 has no index_together.
 
     @models.permalink
     def get_absolute_url(self):
@@ -105,12 +116,18 @@ class BlogCategory(Slugged):
         verbose_name_plural = _("Blog Categories")
         ordering = ("title",)
 
-    @models.permalink
     def get_absolute_url(self):
+        """
+        Listing of vendors for the category within its first parent
+        category, looked up in the site's ``category_tree``.
+        """
+        node = category_tree().categories.get(self.id)
+        if node is not None and node.url is not None:
+            return node.url
         url_name = "get_vendors"
         parent_category_loc = self.parent_category.all()[0]
         kwargs = {"parent_category_slug": parent_category_loc.slug, "sub_category_slug": self.slug}
-        return (url_name, (), kwargs)
+        return reverse(url_name, kwargs=kwargs)
 
 
 class BlogParentCategory(UniqueSlugged):
@@ -140,3 +157,177 @@ def blog_post_saved(sender, created, **kwargs):
             actions.follow(obj.user, obj, send_action=False, actor_only=False) 
 
 post_save.connect(blog_post_saved, sender=BlogPost)
+
+
+def follow_changed(sender, instance, created=False, **kwargs):
+    """
+    Keeps ``BlogPost.followers_count`` current as blog posts are
+    followed and unfollowed, with an update of the count in the
+    database so that concurrent follows aren't lost.
+    """
+    blog_post_id = getattr(instance, "target_blogpost_id", None)
+    if blog_post_id is None:
+        return
+    if kwargs.get("signal") is post_delete:
+        change = -1
+    elif created:
+        change = 1
+    else:
+        return
+    blog_posts = BlogPost._base_manager.filter(id=blog_post_id)
+    blog_posts.update(followers_count=F("followers_count") + change)
+
+post_save.connect(follow_changed, sender=Follow)
+post_delete.connect(follow_changed, sender=Follow)
+
+
+def blog_post_listings_changed(sender, instance, **kwargs):
+    """
+    Invalidates the counts of blog posts stored by ``paginate`` for
+    listings, when categories or keywords are assigned to blog posts,
+    or categories to parent categories, changing the listings they
+    appear in. Deleting a category or parent category removes its
+    assignments without ``m2m_changed`` being sent, so deletes also
+    invalidate the counts. Connected without a sender for keywords,
+    since the generic app imports this module.
+    """
+    from mezzanine.utils.cache import bump_cache_version, cache_installed
+    from mezzanine.utils.cache import cache_tag_label
+    action = kwargs.get("action")
+    if not cache_installed() or (action and not action.startswith("post_")):
+        return
+    if sender._meta.object_name == "AssignedKeyword":
+        content_type = ContentType.objects.get_for_model(BlogPost)
+        if instance.content_type_id != content_type.id:
+            return
+    elif sender in (BlogCategory, BlogParentCategory):
+        if kwargs.get("signal") is not post_delete:
+            return
+    elif sender not in (BlogPost.categories.through,
+                        BlogCategory.parent_category.through):
+        return
+    bump_cache_version(cache_tag_label(BlogPost))
+
+m2m_changed.connect(blog_post_listings_changed,
+                    sender=BlogPost.categories.through)
+m2m_changed.connect(blog_post_listings_changed,
+                    sender=BlogCategory.parent_category.through)
+post_save.connect(blog_post_listings_changed)
+post_delete.connect(blog_post_listings_changed)
+
+
+# Nodes of the ``CategoryTree``. The ``category_ids`` of a parent
+# category and the ``parent_ids`` of a category are tuples ordered by
+# title, and ``url`` is ``None`` if the category's listing isn't routed.
+ParentCategoryNode = namedtuple("ParentCategoryNode",
+                                ("id", "slug", "title", "url",
+                                 "category_ids"))
+CategoryNode = namedtuple("CategoryNode",
+                          ("id", "slug", "title", "url", "parent_ids"))
+
+
+class CategoryTree(object):
+    """
+    Snapshot of the blog parent categories and categories for a site,
+    with the links between them and the URLs of their vendor listings,
+    returned by ``category_tree``. Shared by every request in the
+    process, so it must not be modified.
+    """
+
+    def __init__(self, parents, categories):
+        self.parents = tuple(parents)
+        self.categories = dict([(c.id, c) for c in categories])
+        self.parents_by_id = dict([(p.id, p) for p in self.parents])
+        self.parents_by_slug = dict([(p.slug, p) for p in self.parents])
+        self.categories_by_slug = dict([(c.slug, c) for c in categories])
+
+    def categories_for(self, parent):
+        """
+        Returns the category nodes for the given parent category node,
+        ordered by title.
+        """
+        return [self.categories[i] for i in parent.category_ids]
+
+
+def _category_url(parent_slug, category_slug):
+    """
+    Returns the URL for the vendor listing of a category, or ``None``
+    if the listing isn't routed.
+    """
+    kwargs = {"parent_category_slug": parent_slug,
+              "sub_category_slug": category_slug}
+    try:
+        return reverse("get_vendors", kwargs=kwargs)
+    except NoReverseMatch:
+        return None
+
+
+def _load_category_tree():
+    """
+    Builds the ``CategoryTree`` for the current site with a query for
+    each of the parent categories, the categories, and the links
+    between them.
+    """
+    parents = list(BlogParentCategory.objects.values_list("id", "slug",
+                                                          "title"))
+    categories = list(BlogCategory.objects.values_list("id", "slug",
+                                                       "title"))
+    links = BlogCategory.parent_category.through.objects.filter(
+        blogcategory__in=BlogCategory.objects.values("id"))
+    links = links.order_by("blogparentcategory__title", "blogcategory__title")
+    links = links.values_list("blogcategory", "blogparentcategory")
+    parent_ids = dict([(c[0], []) for c in categories])
+    category_ids = dict([(p[0], []) for p in parents])
+    for (category_id, parent_id) in links:
+        if parent_id in category_ids:
+            parent_ids[category_id].append(parent_id)
+            category_ids[parent_id].append(category_id)
+    parent_slugs = dict([(p[0], p[1]) for p in parents])
+    parent_nodes = [ParentCategoryNode(id, slug, title,
+                                       _category_url(slug, "all"),
+                                       tuple(category_ids[id]))
+                    for (id, slug, title) in parents]
+    category_nodes = []
+    for (id, slug, title) in categories:
+        url = None
+        if parent_ids[id]:
+            url = _category_url(parent_slugs[parent_ids[id][0]], slug)
+        category_nodes.append(CategoryNode(id, slug, title, url,
+                                           tuple(parent_ids[id])))
+    return CategoryTree(parent_nodes, category_nodes)
+
+
+def category_tree():
+    """
+    Returns the ``CategoryTree`` for the current site, which is kept in
+    the process via ``cache_snapshot`` until ``category_tree_changed``
+    is called for the site.
+    """
+    from mezzanine.utils.cache import cache_snapshot
+    from mezzanine.utils.sites import current_site_id
+    name = "blog_categories.%s" % current_site_id()
+    return cache_snapshot(name, _load_category_tree)
+
+
+def category_tree_changed(sender, instance, **kwargs):
+    """
+    Signal handler for parent categories and categories being saved or
+    deleted, or the links between them changing from either side,
+    that expires the ``CategoryTree`` for the site.
+    """
+    from mezzanine.utils.cache import bump_cache_version
+    action = kwargs.get("action")
+    if action and not action.startswith("post_"):
+        return
+    bump_cache_version("blog_categories.%s" % instance.site_id)
+
+post_save.connect(category_tree_changed, sender=BlogCategory)
+post_delete.connect(category_tree_changed, sender=BlogCategory)
+post_save.connect(category_tree_changed, sender=BlogParentCategory)
+post_delete.connect(category_tree_changed, sender=BlogParentCategory)
+m2m_changed.connect(category_tree_changed,
+                    sender=BlogCategory.parent_category.through)
+m2m_changed.connect(typeahead_categories_changed,
+                    sender=BlogCategory.parent_category.through)
+post_save.connect(typeahead_categories_changed, sender=BlogParentCategory)
+post_delete.connect(typeahead_categories_changed, sender=BlogParentCategory)
@@ -0,0 +1,4 @@
+-- Matches the default ordering of the vendor listings. Django runs
+-- this when the table is created by syncdb. For existing databases,
+-- run "python manage.py sqlcustom blog | python manage.py dbshell".
+CREATE INDEX "blog_blogpost_listing" ON "blog_blogpost" ("site_id", "status", "overall_average", "ranking_score");
@@ -1,12 +1,18 @@
 from datetime import datetime
 
+from django.db import connection
 from django.db.models import Count, Q
 
 from mezzanine.blog.forms import BlogPostForm
 from mezzanine.blog.models import BlogPost, BlogCategory, BlogParentCategory
+from mezzanine.blog.models import category_tree
+from mezzanine.conf import settings
 from mezzanine.generic.models import Keyword
 from mezzanine import template
+from mezzanine.utils.cache import cache_installed, cache_tag_label
+from mezzanine.utils.cache import cache_tagged, publish_cache_timeout
 from mezzanine.utils.models import get_user_model
+from mezzanine.utils.sites import current_site_id
 from django.template.defaultfilters import slugify
 from django.utils import simplejson
 
@@ -14,20 +20,44 @@ User = get_user_model()
 
 register = template.Library()
 
+def _blog_months():
+    """
+    Returns the months that published blog posts fall in, newest
+    first, each with the number of posts in it. The posts are grouped
+    by month in the database, so only one row per month is loaded.
+    """
+    qn = connection.ops.quote_name
+    column = "%s.%s" % (qn(BlogPost._meta.db_table), qn("publish_date"))
+    select = {"month": connection.ops.date_trunc_sql("month", column)}
+    posts = BlogPost.objects.published().extra(select=select)
+    counts = posts.values("month").annotate(post_count=Count("id"))
+    month_dicts = []
+    for row in counts.order_by("-month"):
+        month = row["month"]
+        if month is None:
+            continue
+        if isinstance(month, basestring):
+            # SQLite returns the truncated date as a string.
+            month = datetime.strptime(month[:7], "%Y-%m")
+        month_dicts.append({"date": datetime(month.year, month.month, 1),
+                            "post_count": row["post_count"]})
+    return month_dicts
+
+
 @register.as_tag
 def blog_months(*args):
     """
     Put a list of dates for blog posts into the template context.
+    The list is cached per site until a blog post is added, removed,
+    published or unpublished, or the next scheduled post is due.
     """
-    dates = BlogPost.objects.published().values_list("publish_date", flat=True)
-    date_dicts = [{"date": datetime(d.year, d.month, 1)} for d in dates]
-    month_dicts = []
-    for date_dict in date_dicts:
-        if date_dict not in month_dicts:
-            month_dicts.append(date_dict)
-    for i, date_dict in enumerate(month_dicts):
-        month_dicts[i]["post_count"] = date_dicts.count(date_dict)
-    return month_dicts
+    if not cache_installed():
+        return _blog_months()
+    key = "%s.blog_months.%s" % (settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+                                 current_site_id())
+    timeout = lambda: publish_cache_timeout(BlogPost)
+    return cache_tagged(key, [cache_tag_label(BlogPost)], _blog_months,
+                        timeout)
 
 
 @register.as_tag
@@ -52,10 +82,10 @@ def blog_categories_json(*args):
     """
     Put a list of categories for blog posts into the template context.
     """
-    parent_categories = BlogParentCategory.objects.all()
+    tree = category_tree()
     categories = {}
-    for parent_category in parent_categories:
-        sub_categories = BlogCategory.objects.all().filter(parent_category=parent_category)
+    for parent_category in tree.parents:
+        sub_categories = tree.categories_for(parent_category)
         categories[parent_category.title] = [sub_category.title for sub_category in sub_categories]
     return  simplejson.dumps(categories)
 
@@ -6,13 +6,12 @@ from django.utils import simplejson
 from django.template.defaultfilters import slugify
 from django.utils.translation import ugettext_lazy as _
 
-from mezzanine.blog.models import BlogPost, BlogCategory, BlogParentCategory
+from mezzanine.blog.models import BlogPost, BlogCategory, category_tree
 from mezzanine.blog.feeds import PostsRSS, PostsAtom
 from mezzanine.conf import settings
 from mezzanine.generic.models import Keyword
-from mezzanine.utils.views import render, paginate
+from mezzanine.utils.views import render, paginate, paginate_keyset
 from mezzanine.utils.models import get_user_model
-from follow.models import Follow
 
 import urlparse
 
@@ -51,9 +50,16 @@ def blog_post_list(request, tag=None, year=None, month=None, username=None,
 
     prefetch = ("categories", "keywords__keyword")
     blog_posts = blog_posts.select_related("user").prefetch_related(*prefetch)
-    blog_posts = paginate(blog_posts, request.GET.get("page", 1),
-                          settings.BLOG_POST_PER_PAGE,
-                          settings.MAX_PAGING_LINKS)
+    if "cursor" in request.GET:
+        blog_posts = paginate_keyset(blog_posts, request.GET["cursor"],
+                                     settings.BLOG_POST_PER_PAGE)
+    else:
+        count_key = "blog_posts.%s.%s.%s.%s.%s.%s" % (
+            request.user.is_staff, tag and tag.id, year, month,
+            category and category.id, username)
+        blog_posts = paginate(blog_posts, request.GET.get("page", 1),
+                              settings.BLOG_POST_PER_PAGE,
+                              settings.MAX_PAGING_LINKS, count_key)
     context = {"blog_posts": blog_posts, "year": year, "month": month,
                "tag": tag, "category": category, "author": author}
     templates.append(template)
@@ -85,10 +91,11 @@ def blog_post_feed(request, format, **kwargs):
 
 def blog_subcategories(request, category_slug):
     if request.is_ajax():
-        parent_category = BlogParentCategory.objects.get(slug=slugify(category_slug))
+        tree = category_tree()
+        parent_category = tree.parents_by_slug.get(slugify(category_slug))
         if parent_category:
             resultCategoryList = ["All",]
-            sub_categories = BlogCategory.objects.all().filter(parent_category=parent_category).values_list('title', flat=True)
+            sub_categories = [c.title for c in tree.categories_for(parent_category)]
             resultCategoryList = resultCategoryList + list(sub_categories)
             return HttpResponse(simplejson.dumps(resultCategoryList))
         return HttpResponse(simplejson.dumps("error"))
@@ -128,33 +135,31 @@ def get_vendors(request, parent_category_slug, sub_category_slug, template="blog
         blog_parentcategory_slug = parent_category_slug#pathlist[-3]
         blog_parentcategory_title = _("All")
 
-        if blog_parentcategory_slug.lower() != "all" and BlogParentCategory.objects.all().exists():
-            try:
-                blog_parentcategory = BlogParentCategory.objects.get(slug=slugify(blog_parentcategory_slug))
-                blog_parentcategory_title = blog_parentcategory.title
-            except BlogParentCategory.DoesNotExist:
+        tree = category_tree()
+        if blog_parentcategory_slug.lower() != "all" and tree.parents:
+            blog_parentcategory = tree.parents_by_slug.get(slugify(blog_parentcategory_slug))
+            if blog_parentcategory is None:
                 raise Http404()
+            blog_parentcategory_title = blog_parentcategory.title
 
-        table_name = BlogPost._meta.db_table
         blog_subcategory = None
         blog_subcategory_slug = sub_category_slug#pathlist[-2]
         blog_subcategory_title = _("All")
-        if blog_subcategory_slug.lower() != "all" and BlogCategory.objects.all().exists():
-            try:
-                blog_subcategory = BlogCategory.objects.get(slug=slugify(blog_subcategory_slug))
-                blog_subcategory_title = blog_subcategory.title
-            except BlogCategory.DoesNotExist:
+        if blog_subcategory_slug.lower() != "all" and tree.categories:
+            blog_subcategory = tree.categories_by_slug.get(slugify(blog_subcategory_slug))
+            if blog_subcategory is None:
                 raise Http404()
+            blog_subcategory_title = blog_subcategory.title
 
         if blog_parentcategory_slug.lower() == "all" and blog_subcategory_slug.lower() == "all":
             results = BlogPost.objects.published().distinct()
         elif blog_parentcategory_slug.lower() != "all" and blog_subcategory_slug.lower() == "all":
             if blog_parentcategory:
-                blog_subcategories = BlogCategory.objects.all().filter(parent_category=blog_parentcategory).values_list('id', flat=True)
+                blog_subcategories = blog_parentcategory.category_ids
                 results = BlogPost.objects.published().filter(categories__id__in=blog_subcategories).distinct()
         else:
             if blog_subcategory and blog_parentcategory:
-                results = BlogPost.objects.published().filter(categories=blog_subcategory).distinct()
+                results = BlogPost.objects.published().filter(categories__id=blog_subcategory.id).distinct()
             else:
             	"""
                 raise 404 error, in case categories are not present.
@@ -176,24 +181,27 @@ def get_vendors(request, parent_category_slug, sub_category_slug, template="blog
         	In case filter values are equal, order them as per their overall average.
         	For now tie between equal overall_average is not broken. To break add more parameters ahead in order of priority.
         	'''
-        	filtered_results = results.extra(select={'filtersum': filter_sum,
-                                                     'fieldsum':'price_average + website_ex_average + quality_average + service_average',
-                                                     'followers': 'SELECT COUNT(*) FROM %s WHERE target_blogpost_id=%s.id' % (Follow._meta.db_table, table_name)},
-                                                     order_by=('-filtersum', '-overall_average', '-fieldsum', '-comments_count', '-followers',)).distinct()
+        	filtered_results = results.extra(select={'filtersum': filter_sum},
+                                                     order_by=('-filtersum', '-overall_average', '-ranking_score', '-comments_count', '-followers_count',)).distinct()
         else:
         	'''
         		In absence of any filters, order vendors by overall_average by default.
         	'''
-        	filtered_results = results.extra(select={'fieldsum':'price_average + website_ex_average + quality_average + service_average',
-                                                     'followers': 'SELECT COUNT(*) FROM %s WHERE target_blogpost_id=%s.id' % (Follow._meta.db_table, table_name)},
-                                                     order_by=('-overall_average', '-fieldsum', '-comments_count', '-followers',)).distinct()
+        	filtered_results = results.extra(order_by=('-overall_average', '-ranking_score', '-comments_count', '-followers_count',)).distinct()
 
         settings.use_editable()
         page = request.GET.get("page", 1)
         per_page = settings.SEARCH_PER_PAGE
         max_paging_links = settings.MAX_PAGING_LINKS
 
-        paginated = paginate(filtered_results, page, per_page, max_paging_links)
+        if "cursor" in request.GET:
+            paginated = paginate_keyset(filtered_results,
+                                        request.GET["cursor"], per_page)
+        else:
+            count_key = "vendors.%s.%s" % (parent_category_slug.lower(),
+                                           sub_category_slug.lower())
+            paginated = paginate(filtered_results, page, per_page,
+                                 max_paging_links, count_key)
         context = {"results": paginated,
                     "parent_category": parent_category_slug,
                     "sub_category": sub_category_slug,
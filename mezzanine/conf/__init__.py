@@ -15,6 +15,10 @@ from mezzanine import __version__
 
 registry = {}
 
+# Name of the cached version for the editable settings stored in the
+# DB for each site, formatted with the site ID.
+EDITABLE_SETTINGS = "editable_settings.%s"
+
 
 def register_setting(name="", label="", editable=False, description="",
                      default=None, choices=None, append=False):
@@ -72,22 +76,77 @@ class Settings(object):
         is first created. It's then set to ``False`` whenever the
         ``use_editable`` method is called, which should be called
         before using editable settings in the database.
-        ``_editable_cache`` is the dict that stores the editable
-        settings once they're loaded from the database, the first
-        time an editable setting is accessed.
+        ``_editable_caches`` maps each site ID to the version the
+        site's editable settings were loaded for, and the dict that
+        stores them once they're loaded from the database, the first
+        time an editable setting is accessed for the site.
         """
         self._loaded = True
-        self._editable_cache = {}
+        self._editable_caches = {}
 
     def use_editable(self):
         """
-        Empty the editable settings cache and set the loaded flag to
-        ``False`` so that settings will be loaded from the DB on next
-        access. If the conf app is not installed then set the loaded
-        flag to ``True`` in order to bypass DB lookup entirely.
+        Set the loaded flag to ``False`` so that settings will be
+        loaded from the DB on next access, if they've changed. If the
+        conf app is not installed then set the loaded flag to ``True``
+        in order to bypass DB lookup entirely.
         """
         self._loaded = __name__ not in getattr(self, "INSTALLED_APPS")
-        self._editable_cache = {}
+
+    def _editable_cache(self):
+        """
+        Returns the editable settings for the current site, loading
+        them if ``use_editable`` has been called since they were last
+        loaded, or if they haven't been loaded for the site yet.
+        """
+        from mezzanine.utils.sites import current_site_id
+        site_id = current_site_id()
+        loaded = self._editable_caches
+        if not self._loaded or (loaded and site_id not in loaded):
+            self._load_editable(site_id)
+        return loaded.get(site_id, (None, {}))[1]
+
+    def _load_editable(self, site_id):
+        """
+        Load the site's editable settings from the DB into the cache,
+        and remove settings from the DB that are no longer registered.
+        With Mezzanine's cache middleware installed, the DB is only
+        queried when the version stored in the cache backend for the
+        site's editable settings has changed since they were last
+        loaded by this process, which occurs when the settings form
+        in the admin is saved for the site.
+        """
+        from mezzanine.utils.cache import cache_installed, cache_version
+        version = None
+        if cache_installed():
+            version = cache_version(EDITABLE_SETTINGS % site_id)
+            loaded = self._editable_caches.get(site_id)
+            if loaded is not None and loaded[0] == version:
+                self._loaded = True
+                return
+        from mezzanine.conf.models import Setting
+        editable_cache = {}
+        removed = []
+        for setting_obj in Setting.objects.all():
+            try:
+                setting_type = registry[setting_obj.name]["type"]
+            except KeyError:
+                removed.append(setting_obj.id)
+            else:
+                if setting_type is bool:
+                    setting_value = setting_obj.value != "False"
+                else:
+                    try:
+                        setting_value = setting_type(setting_obj.value)
+                    except ValueError:
+                        # Invalid values stored without the settings
+                        # form's validation fall back to the default.
+                        continue
+                editable_cache[setting_obj.name] = setting_value
+        if removed:
+            Setting.objects.filter(id__in=removed).delete()
+        self._editable_caches[site_id] = (version, editable_cache)
+        self._loaded = True
 
     def __getattr__(self, name):
 
@@ -97,35 +156,17 @@ class Settings(object):
         except KeyError:
             return getattr(django_settings, name)
 
-        # First access for an editable setting - load from DB into cache.
-        # Also remove settings from the DB that are no longer registered.
-        if setting["editable"] and not self._loaded:
-            from mezzanine.conf.models import Setting
-            settings = Setting.objects.all()
-            removed = []
-            for setting_obj in settings:
-                try:
-                    setting_type = registry[setting_obj.name]["type"]
-                except KeyError:
-                    removed.append(setting_obj.id)
-                else:
-                    if setting_type is bool:
-                        setting_value = setting_obj.value != "False"
-                    else:
-                        setting_value = setting_type(setting_obj.value)
-                    self._editable_cache[setting_obj.name] = setting_value
-            if removed:
-                Setting.objects.filter(id__in=removed).delete()
-            self._loaded = True
-
-        # Use cached editable setting if found, otherwise use the
-        # value defined in the project's settings.py module if it
+        # Use the editable setting stored in the DB for the current
+        # site if found, loading them on first access, otherwise use
+        # the value defined in the project's settings.py module if it
         # exists, finally falling back to the default defined when
         # registered.
-        try:
-            return self._editable_cache[name]
-        except KeyError:
-            return getattr(django_settings, name, setting["default"])
+        if setting["editable"]:
+            try:
+                return self._editable_cache()[name]
+            except KeyError:
+                pass
+        return getattr(django_settings, name, setting["default"])
 
 
 mezz_first = lambda app: not app.startswith("mezzanine.")
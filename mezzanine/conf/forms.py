@@ -6,13 +6,16 @@ from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import urlize
 
-from mezzanine.conf import settings, registry
+from mezzanine.conf import settings, registry, EDITABLE_SETTINGS
 from mezzanine.conf.models import Setting
+from mezzanine.utils.cache import bump_cache_version
+from mezzanine.utils.sites import current_site_id
 
 
 FIELD_TYPES = {
     bool: forms.BooleanField,
     int: forms.IntegerField,
+    float: forms.FloatField,
 }
 
 
@@ -32,7 +35,7 @@ class SettingsForm(forms.Form):
                 field_class = FIELD_TYPES.get(setting["type"], forms.CharField)
                 kwargs = {
                     "label": setting["label"] + ":",
-                    "required": setting["type"] == int,
+                    "required": setting["type"] in (int, float),
                     "initial": getattr(settings, name),
                     "help_text": self.format_help(setting["description"]),
                 }
@@ -62,12 +65,14 @@ class SettingsForm(forms.Form):
 
     def save(self):
         """
-        Save each of the settings to the DB.
+        Save each of the settings to the DB for the current site, and
+        expire the site's editable settings loaded by each process.
         """
         for (name, value) in self.cleaned_data.items():
             setting_obj, created = Setting.objects.get_or_create(name=name)
             setting_obj.value = value
             setting_obj.save()
+        bump_cache_version(EDITABLE_SETTINGS % current_site_id())
 
     def format_help(self, description):
         """
@@ -60,6 +60,36 @@ register_setting(
     default="",
 )
 
+register_setting(
+    name="CACHE_KEY_IGNORED_PARAMS",
+    description=_("Sequence of querystring parameter names that are "
+        "removed from URLs when building the keys for pages stored by "
+        "Mezzanine's cache middleware, such as campaign tracking "
+        "parameters that don't affect the page. Shell-style wildcards "
+        "are supported. The ``t`` parameter is used to force a page to "
+        "be regenerated, which is then stored without it."),
+    editable=False,
+    default=("utm_*", "fbclid", "gclid", "t"),
+)
+
+register_setting(
+    name="CACHE_KEY_LOWERCASE_PARAMS",
+    description=_("Sequence of querystring parameter names whose values "
+        "are case insensitive, and are lowercased when building the keys "
+        "for pages stored by Mezzanine's cache middleware."),
+    editable=False,
+    default=("filter",),
+)
+
+register_setting(
+    name="CACHE_REFRESH_THREADS",
+    description=_("Number of background threads per process used to "
+        "regenerate stale cache entries when "
+        "``CACHE_STALE_WHILE_REVALIDATE`` is ``True``."),
+    editable=False,
+    default=2,
+)
+
 register_setting(
     name="CACHE_SET_DELAY_SECONDS",
     description=_("Mezzanine's caching uses a technique know as mint "
@@ -75,6 +105,32 @@ register_setting(
     default=30,
 )
 
+register_setting(
+    name="CACHE_STALE_WHILE_REVALIDATE",
+    description=_("If ``True``, expired pages in Mezzanine's cache "
+        "middleware are served stale to every visitor, including the one "
+        "whose request found them expired, while a single process "
+        "(coordinated via a lease stored in the cache backend) "
+        "regenerates the page on a background thread. The lease expires "
+        "after ``CACHE_SET_DELAY_SECONDS``."),
+    editable=False,
+    default=False,
+)
+
+register_setting(
+    name="CACHE_TAG_MODELS",
+    description=_("Sequence of models in the format "
+        "``app_label.object_name`` whose instances, along with those of "
+        "models that subclass ``mezzanine.core.models.Displayable``, are "
+        "used to tag pages stored by Mezzanine's cache middleware. When "
+        "one of these instances is saved or deleted, the cached pages "
+        "tagged with it are invalidated. Subclasses of each model are "
+        "also included, eg ``generic.Review`` via "
+        "``generic.ThreadedComment``."),
+    editable=False,
+    default=("generic.ThreadedComment", "generic.Keyword"),
+)
+
 if "mezzanine.blog" in settings.INSTALLED_APPS:
     dashboard_tags = (
         ("blog_tags.quick_blog", "mezzanine_tags.app_list"),
@@ -315,6 +371,34 @@ register_setting(
     default=RICHTEXT_FILTER_LEVEL_HIGH,
 )
 
+register_setting(
+    name="SEARCH_FEDERATED_RESULTS",
+    description=_("Maximum number of results returned when searching "
+        "across several models at once, such as every model that "
+        "subclasses ``mezzanine.core.models.Displayable``. This many "
+        "results are retrieved from each model and merged by relevance."),
+    editable=False,
+    default=100,
+)
+
+register_setting(
+    name="SEARCH_FEDERATED_THREADS",
+    description=_("Number of threads used to search different models "
+        "concurrently when searching across several models at once."),
+    editable=False,
+    default=4,
+)
+
+register_setting(
+    name="SEARCH_FUZZY_THRESHOLD",
+    label=_("Search similarity threshold"),
+    description=_("When a search for vendors returns no results, vendors "
+        "whose names or keywords are at least this similar to the query, "
+        "from 0 to 1, are shown instead, to allow for misspellings."),
+    editable=True,
+    default=0.3,
+)
+
 register_setting(
     name="SEARCH_MODEL_CHOICES",
     description=_("Sequence of models that will be provided by default as "
@@ -333,6 +417,17 @@ register_setting(
     default=10,
 )
 
+register_setting(
+    name="SEARCH_USE_INDEX",
+    description=_("If ``True``, searches query an index of the stemmed "
+        "words in each model's search fields, rather than scanning the "
+        "fields themselves. Words in ``STOP_WORDS`` aren't indexed, and "
+        "quoted phrases are only checked against the fields of the "
+        "instances that contain each of their words."),
+    editable=False,
+    default=False,
+)
+
 register_setting(
     name="SITE_PREFIX",
     description=_("A URL prefix for mounting all of Mezzanine's urlpatterns "
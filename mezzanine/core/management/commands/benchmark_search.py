@@ -0,0 +1,217 @@
+
+import resource
+from datetime import datetime
+from optparse import make_option
+from random import Random
+from time import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import RequestFactory
+from django.utils import simplejson
+
+from mezzanine.conf import settings
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+from mezzanine.utils.cache import bump_cache_version, cache_tag_label
+from mezzanine.utils.models import get_user_model
+from mezzanine.utils.sites import current_site_id
+
+
+User = get_user_model()
+
+
+# Words that titles, content and keywords for the corpus are made of.
+WORDS = ("stella", "bella", "royal", "golden", "garden", "grand", "silver",
+         "classic", "modern", "urban", "studio", "events", "wedding",
+         "caterers", "flowers", "photography", "decor", "music", "cakes",
+         "venue", "lights", "designs", "bridal", "party", "planners")
+
+# Queries run against the corpus, as ``(name, query, filters)``.
+QUERIES = (
+    ("word", "caterers", ""),
+    ("words", "wedding photography", ""),
+    ("phrase", '"golden flowers"', ""),
+    ("required", "+bridal cakes", ""),
+    ("excluded", "music -party", ""),
+    ("filters", "decor", "price-quality"),
+    ("misspelt", "photgraphy", ""),
+)
+
+
+def peak_memory():
+    """
+    Returns the peak memory used by the process so far in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, percent):
+    """
+    Returns the nearest rank percentile of the given values.
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = int(round(percent / 100. * len(values) + .5)) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class Command(BaseCommand):
+    """
+    Generates a synthetic corpus of blog posts, keywords and
+    categories for the current site, then times a fixed mix of
+    queries run through ``SearchableQuerySet.search`` and the search
+    view, reporting the p50 and p95 latency, the number of database
+    queries and the growth in peak memory for each, and the peak
+    memory for the whole run. The corpus is created
+    in a transaction that's rolled back afterwards, and the results
+    can be saved as JSON to compare runs across commits.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option("--posts", dest="posts", type="int", default=1000,
+            help="Number of blog posts to generate."),
+        make_option("--keywords", dest="keywords", type="int", default=100,
+            help="Number of keywords to generate."),
+        make_option("--categories", dest="categories", type="int",
+            default=20, help="Number of categories to generate."),
+        make_option("--runs", dest="runs", type="int", default=20,
+            help="Number of times to run each query."),
+        make_option("--seed", dest="seed", type="int", default=0,
+            help="Seed for generating the corpus."),
+        make_option("--output", dest="output",
+            help="File to save the results to as JSON."),
+    )
+
+    def handle(self, *args, **options):
+        if "mezzanine.blog" not in settings.INSTALLED_APPS:
+            raise CommandError("The corpus is made of blog posts, so "
+                               "mezzanine.blog must be installed.")
+        verbosity = int(options.get("verbosity", 1))
+        runs = max(options.get("runs"), 1)
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            start = time()
+            corpus = self.generate(options)
+            corpus["seconds"] = time() - start
+            if verbosity >= 1:
+                self.stdout.write("Generated %(posts)s posts, %(keywords)s "
+                                  "keywords and %(categories)s categories "
+                                  "in %(seconds).2fs\n" % corpus)
+            results = []
+            for (name, query, filters) in QUERIES:
+                for (target, search) in (("manager", self.search_manager),
+                                         ("view", self.search_view)):
+                    result = self.measure(search, query, filters, runs)
+                    result.update({"name": name, "target": target,
+                                   "query": query, "filters": filters})
+                    results.append(result)
+                    if verbosity >= 1:
+                        self.stdout.write(self.format(result))
+            peak = peak_memory()
+            if verbosity >= 1:
+                self.stdout.write("Peak memory %sKB\n" % peak)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            transaction.rollback()
+            transaction.leave_transaction_management()
+            # Expire anything cached for the rolled back corpus.
+            site_id = current_site_id()
+            from mezzanine.blog.models import BlogPost
+            bump_cache_version("%s.*" % cache_tag_label(BlogPost),
+                               "typeahead.%s" % site_id,
+                               "trigrams.%s" % site_id)
+
+        output = options.get("output")
+        if output:
+            data = {"date": datetime.now().isoformat(), "corpus": corpus,
+                    "runs": runs, "results": results, "peak_memory": peak}
+            with open(output, "w") as f:
+                simplejson.dump(data, f, indent=2)
+
+    def generate(self, options):
+        """
+        Creates the blog posts, keywords and categories for the
+        corpus, with keywords and categories assigned to each post.
+        """
+        from mezzanine.blog.models import BlogCategory, BlogParentCategory
+        from mezzanine.blog.models import BlogPost
+        from mezzanine.generic.models import AssignedKeyword, Keyword
+        random = Random(options.get("seed"))
+        phrase = lambda length: " ".join([random.choice(WORDS)
+                                          for i in range(length)])
+        user, _ = User.objects.get_or_create(username="search-benchmark")
+        parent = BlogParentCategory.objects.create(title="Benchmark")
+        categories = []
+        for i in range(options.get("categories")):
+            category = BlogCategory.objects.create(title=phrase(2))
+            category.parent_category.add(parent)
+            categories.append(category)
+        keywords = [Keyword.objects.create(title=phrase(2))
+                    for i in range(options.get("keywords"))]
+        for i in range(options.get("posts")):
+            post = BlogPost.objects.create(title=phrase(3), user=user,
+                                           content=phrase(100),
+                                           status=CONTENT_STATUS_PUBLISHED)
+            if categories:
+                post.categories.add(*random.sample(categories,
+                                                   min(2, len(categories))))
+            if keywords:
+                assigned = random.sample(keywords, min(3, len(keywords)))
+                post.keywords.add(*[AssignedKeyword(keyword=keyword)
+                                    for keyword in assigned])
+        return {"posts": options.get("posts"), "categories": len(categories),
+                "keywords": len(keywords), "site_id": current_site_id()}
+
+    def search_manager(self, query, filters):
+        """
+        Loads the first page of results for the query via
+        ``SearchableQuerySet.search``. Filters only apply to the view.
+        """
+        from mezzanine.blog.models import BlogPost
+        list(BlogPost.objects.search(query)[:settings.SEARCH_PER_PAGE])
+
+    def search_view(self, query, filters):
+        """
+        Renders the search view for the query and filters.
+        """
+        from mezzanine.core.views import search
+        data = {"q": query, "type": "blog.BlogPost"}
+        if filters:
+            data["filter"] = filters
+        request = RequestFactory().get("/search/", data)
+        request.user = AnonymousUser()
+        request.session = {}
+        response = search(request)
+        if hasattr(response, "render"):
+            response.render()
+
+    def measure(self, search, query, filters, runs):
+        """
+        Runs the search the given number of times, and returns the
+        p50 and p95 latency in milliseconds, the average number of
+        database queries, and the kilobytes by which the process' peak
+        memory grew while the search ran, since the peak itself only
+        reflects the largest of all the searches run so far.
+        """
+        timings = []
+        queries = 0
+        start_memory = peak_memory()
+        for i in range(runs):
+            connection.queries = []
+            start = time()
+            search(query, filters)
+            timings.append((time() - start) * 1000)
+            queries += len(connection.queries)
+        connection.queries = []
+        return {"p50": percentile(timings, 50), "p95": percentile(timings, 95),
+                "queries": float(queries) / runs,
+                "memory_growth": peak_memory() - start_memory}
+
+    def format(self, result):
+        return ("%(target)-8s %(name)-10s p50 %(p50)7.1fms  p95 %(p95)7.1fms"
+                "  %(queries)5.1f queries  +%(memory_growth)sKB\n" % result)
@@ -0,0 +1,121 @@
+
+from multiprocessing import Pool
+from optparse import make_option
+from time import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import get_model, get_models
+
+from mezzanine.core.models import SearchTerm
+from mezzanine.core.search import index_instances, searchable_fields
+
+
+def rebuild(args):
+    """
+    Rebuilds the search index for a single model, walking its rows in
+    chunks of primary keys so that only one chunk is held in memory at
+    a time. Rows belonging to subclasses with their own table are left
+    to be indexed for the subclass. Returns the model's label, the
+    number of rows indexed, and the time taken.
+    """
+    (label, chunk_size) = args
+    model = get_model(*label.split(".", 1))
+    start = time()
+    queryset = model._base_manager.all()
+    for subclass in get_models():
+        if (subclass is not model and issubclass(subclass, model) and
+            not subclass._meta.proxy):
+            subclass_ids = subclass._base_manager.values("pk")
+            queryset = queryset.exclude(pk__in=subclass_ids)
+    queryset = queryset.order_by("pk")
+    rows = 0
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        instances = list(chunk[:chunk_size].iterator())
+        if not instances:
+            break
+        index_instances(model, instances)
+        rows += len(instances)
+        last_pk = instances[-1].pk
+    # Remove terms for rows deleted without the signal being sent,
+    # such as with raw SQL.
+    content_type = ContentType.objects.get_for_model(model)
+    stale = SearchTerm.objects.filter(content_type=content_type)
+    stale.exclude(object_pk__in=queryset.values("pk")).delete()
+    return label, rows, time() - start
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the search index used when the ``SEARCH_USE_INDEX``
+    setting is ``True``, for each model with a ``SearchableManager``,
+    or for the models given as ``app_label.ModelName`` arguments.
+    The index is kept up to date as instances are saved and deleted,
+    so this only needs to be run when the index is first enabled, or
+    after data is changed without signals being sent.
+    """
+
+    args = "[app_label.ModelName ...]"
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size", dest="chunk_size", type="int",
+            default=500, help="Number of rows to index at once."),
+        make_option("--processes", dest="processes", type="int", default=1,
+            help="Number of models to index at once, each in a separate "
+                 "process."),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get("verbosity", 1))
+        chunk_size = max(options.get("chunk_size"), 1)
+        if not labels:
+            labels = ["%s.%s" % (m._meta.app_label, m._meta.object_name)
+                      for m in get_models()
+                      if searchable_fields(m) and not m._meta.proxy]
+        for label in labels:
+            try:
+                model = get_model(*label.split(".", 1))
+            except TypeError:
+                model = None
+            if model is None or not searchable_fields(model):
+                raise CommandError("%s is not a searchable model." % label)
+
+        start = time()
+        args = [(label, chunk_size) for label in labels]
+        processes = max(options.get("processes"), 1)
+        if processes > 1:
+            # Each process opens its own database connection, rather
+            # than sharing the one opened so far.
+            connection.close()
+            pool = Pool(processes)
+            try:
+                results = pool.imap_unordered(rebuild, args)
+                total = self.report(results, verbosity)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            total = self.report(map(rebuild, args), verbosity)
+
+        if verbosity >= 1:
+            duration = time() - start
+            self.stdout.write("Indexed %s rows in %.2fs (%.0f rows/sec)\n" %
+                              (total, duration, total / max(duration, .001)))
+
+    def report(self, results, verbosity):
+        """
+        Writes the rows per second for each model as it's indexed,
+        and returns the total number of rows.
+        """
+        total = 0
+        for (label, rows, duration) in results:
+            total += rows
+            if verbosity >= 1:
+                self.stdout.write("%s: %s rows in %.2fs (%.0f rows/sec)\n" %
+                                  (label, rows, duration,
+                                   rows / max(duration, .001)))
+        return total
@@ -0,0 +1,126 @@
+
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from threading import Lock
+from time import sleep, time
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import NoReverseMatch
+from django.test.client import RequestFactory
+
+from mezzanine.conf import settings
+from mezzanine.core.sitemaps import DisplayableSitemap
+from mezzanine.utils.cache import cache_installed, cache_refresh
+from mezzanine.utils.sites import current_site_id
+
+
+class Command(BaseCommand):
+    """
+    Renders the pages listed in the sitemap, along with the blog
+    category listings, through Mezzanine's cache middleware so that
+    they're stored in the cache before being requested by visitors.
+    Each page is rendered once for the default device, and once for
+    each device defined by the ``DEVICE_USER_AGENTS`` setting.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option("--threads", dest="threads", type="int", default=4,
+            help="Number of pages to render at once."),
+        make_option("--rate", dest="rate", type="float", default=0,
+            help="Maximum number of pages to render per second. "
+                 "Defaults to no limit."),
+        make_option("--host", dest="host",
+            help="Host name to render pages for. Defaults to the "
+                 "domain of the current site."),
+        make_option("--no-devices", action="store_false", dest="devices",
+            default=True, help="Only render pages for the default device."),
+    )
+
+    def handle(self, *args, **options):
+        if not cache_installed():
+            raise CommandError("Mezzanine's cache middleware is not "
+                               "installed.")
+        verbosity = int(options.get("verbosity", 1))
+        host = options.get("host")
+        if not host:
+            host = Site.objects.get(id=current_site_id()).domain
+        user_agents = [("", "")]
+        if options.get("devices"):
+            user_agents += [(device, agents[0]) for (device, agents)
+                            in settings.DEVICE_USER_AGENTS if agents]
+        factory = RequestFactory()
+        environs = []
+        for url in self.urls():
+            for (device, user_agent) in user_agents:
+                request = factory.get(url, HTTP_HOST=host,
+                                      HTTP_USER_AGENT=user_agent)
+                environs.append((url, device, request.environ))
+
+        # Each page waits for its slot under the rate limit before
+        # being rendered.
+        rate = options.get("rate")
+        lock = Lock()
+        next_start = [time()]
+
+        def warm((url, device, environ)):
+            if rate:
+                with lock:
+                    wait = next_start[0] - time()
+                    next_start[0] = max(next_start[0], time()) + 1. / rate
+                if wait > 0:
+                    sleep(wait)
+            start = time()
+            try:
+                status = cache_refresh(environ)
+            except Exception, e:
+                status = "error: %s" % e
+            return url, device, status, time() - start
+
+        start = time()
+        pool = ThreadPool(max(options.get("threads"), 1))
+        try:
+            results = []
+            for result in pool.imap_unordered(warm, environs):
+                results.append(result)
+                if verbosity >= 2:
+                    self.stdout.write(self.format(result))
+        finally:
+            pool.close()
+            pool.join()
+
+        if verbosity >= 1:
+            if verbosity == 1:
+                results.sort(key=lambda result: result[-1], reverse=True)
+                for result in results:
+                    self.stdout.write(self.format(result))
+            errors = len([r for r in results if not r[2].startswith("200")])
+            self.stdout.write("Rendered %s pages in %.2fs, %s failed\n" %
+                              (len(results), time() - start, errors))
+
+    def format(self, (url, device, status, duration)):
+        device = " [%s]" % device if device else ""
+        return "%7.0fms  %s  %s%s\n" % (duration * 1000, status.split(" ")[0],
+                                        url, device)
+
+    def urls(self):
+        """
+        Returns the URLs for the items in the sitemap, followed by
+        the category listings for the blog.
+        """
+        urls = [item.get_absolute_url() for item in
+                DisplayableSitemap().items()]
+        if "mezzanine.blog" in settings.INSTALLED_APPS:
+            from mezzanine.blog.models import BlogCategory, BlogParentCategory
+            categories = list(BlogParentCategory.objects.all())
+            categories += list(BlogCategory.objects.all())
+            for category in categories:
+                try:
+                    url = category.get_absolute_url()
+                except (NoReverseMatch, IndexError):
+                    # Categories without a parent, or projects that
+                    # don't route the category listings.
+                    continue
+                if url not in urls:
+                    urls.append(url)
+        return urls
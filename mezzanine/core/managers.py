@@ -1,17 +1,31 @@
 
+from heapq import merge
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from operator import ior, iand
 from string import punctuation
+from threading import Lock
+from time import time
 
+from django.db import connection
 from django.db.models import Manager, Q, CharField, TextField, get_models
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.manager import ManagerDescriptor
 from django.db.models.query import QuerySet
 from django.contrib.sites.managers import CurrentSiteManager as DjangoCSM
 from django.utils.timezone import now
 
 from mezzanine.conf import settings
+from mezzanine.core.search import index_content_types, index_terms
+from mezzanine.core.search import postings
+from mezzanine.utils.cache import cache_tag_loaded
 from mezzanine.utils.sites import current_site_id
 
 
+_search_pool_instance = None
+_search_pool_lock = Lock()
+
+
 class PublishedManager(Manager):
     """
     Provides filter for restricting items returned by status and
@@ -53,6 +67,39 @@ def search_fields_to_dict(fields):
     return fields
 
 
+def parse_search_query(query):
+    """
+    Returns the list of terms in the given search query, treating
+    quoted terms as phrases and keeping any + or - modifier at the
+    start of each term, along with the list of lowercase terms that
+    don't use the - modifier, which are used for scoring results.
+    """
+    # Remove extra spaces, put modifiers inside quoted terms.
+    terms = " ".join(query.split()).replace("+ ", "+")     \
+                                   .replace('+"', '"+')    \
+                                   .replace("- ", "-")     \
+                                   .replace('-"', '"-')    \
+                                   .split('"')
+    # Strip punctuation other than modifiers from terms and create
+    # terms list, first from quoted terms and then remaining words.
+    terms = [("" if t[0:1] not in "+-" else t[0:1]) + t.strip(punctuation)
+        for t in terms[1::2] + "".join(terms[::2]).split()]
+    # Remove stop words from terms that aren't quoted or use
+    # modifiers, since words with these are an explicit part of
+    # the search query. If doing so ends up with an empty term
+    # list, then keep the stop words.
+    terms_no_stopwords = [t for t in terms if t.lower() not in
+        settings.STOP_WORDS]
+    get_positive_terms = lambda terms: [t.lower().strip(punctuation)
+        for t in terms if t[0:1] != "-"]
+    positive_terms = get_positive_terms(terms_no_stopwords)
+    if positive_terms:
+        terms = terms_no_stopwords
+    else:
+        positive_terms = get_positive_terms(terms)
+    return terms, positive_terms
+
+
 class SearchableQuerySet(QuerySet):
     """
     QuerySet providing main search functionality for
@@ -60,7 +107,6 @@ class SearchableQuerySet(QuerySet):
     """
 
     def __init__(self, *args, **kwargs):
-        self._search_ordered = False
         self._search_terms = set()
         self._search_fields = kwargs.pop("search_fields", {})
         super(SearchableQuerySet, self).__init__(*args, **kwargs)
@@ -70,7 +116,9 @@ class SearchableQuerySet(QuerySet):
         Build a queryset matching words in the given search query,
         treating quoted terms as exact phrases and taking into
         account + and - symbols as modifiers controlling which terms
-        to require and exclude.
+        to require and exclude. With the ``SEARCH_USE_INDEX``
+        setting, terms are matched using the search index when
+        searching the manager's own search fields.
         """
 
         #### DETERMINE FIELDS TO SEARCH ###
@@ -81,48 +129,25 @@ class SearchableQuerySet(QuerySet):
             self._search_fields = search_fields_to_dict(search_fields)
         if not self._search_fields:
             return self.none()
+        use_index = settings.SEARCH_USE_INDEX and not search_fields
 
         #### BUILD LIST OF TERMS TO SEARCH FOR ###
 
-        # Remove extra spaces, put modifiers inside quoted terms.
-        terms = " ".join(query.split()).replace("+ ", "+")     \
-                                       .replace('+"', '"+')    \
-                                       .replace("- ", "-")     \
-                                       .replace('-"', '"-')    \
-                                       .split('"')
-        # Strip punctuation other than modifiers from terms and create
-        # terms list, first from quoted terms and then remaining words.
-        terms = [("" if t[0:1] not in "+-" else t[0:1]) + t.strip(punctuation)
-            for t in terms[1::2] + "".join(terms[::2]).split()]
-        # Remove stop words from terms that aren't quoted or use
-        # modifiers, since words with these are an explicit part of
-        # the search query. If doing so ends up with an empty term
-        # list, then keep the stop words.
-        terms_no_stopwords = [t for t in terms if t.lower() not in
-            settings.STOP_WORDS]
-        get_positive_terms = lambda terms: [t.lower().strip(punctuation)
-            for t in terms if t[0:1] != "-"]
-        positive_terms = get_positive_terms(terms_no_stopwords)
-        if positive_terms:
-            terms = terms_no_stopwords
-        else:
-            positive_terms = get_positive_terms(terms)
+        terms, positive_terms = parse_search_query(query)
         # Append positive terms (those without the negative modifier)
-        # to the internal list for sorting when results are iterated.
+        # to the internal list for scoring results.
         if not positive_terms:
             return self.none()
         else:
-            self._search_terms.update(positive_terms)
+            self._search_terms = self._search_terms | set(positive_terms)
 
         #### BUILD QUERYSET FILTER ###
 
         # Create the queryset combining each set of terms.
-        excluded = [reduce(iand, [~Q(**{"%s__icontains" % f: t[1:]}) for f in
-            self._search_fields.keys()]) for t in terms if t[0:1] == "-"]
-        required = [reduce(ior, [Q(**{"%s__icontains" % f: t[1:]}) for f in
-            self._search_fields.keys()]) for t in terms if t[0:1] == "+"]
-        optional = [reduce(ior, [Q(**{"%s__icontains" % f: t}) for f in
-            self._search_fields.keys()]) for t in terms if t[0:1] not in "+-"]
+        term_filter = lambda t: self._term_filter(t, use_index)
+        excluded = [~term_filter(t[1:]) for t in terms if t[0:1] == "-"]
+        required = [term_filter(t[1:]) for t in terms if t[0:1] == "+"]
+        optional = [term_filter(t) for t in terms if t[0:1] not in "+-"]
         queryset = self
         if excluded:
             queryset = queryset.filter(reduce(iand, excluded))
@@ -132,43 +157,90 @@ class SearchableQuerySet(QuerySet):
         # terms that are explicitly required.
         elif optional:
             queryset = queryset.filter(reduce(ior, optional))
-        return queryset
-
-    def _clone(self, *args, **kwargs):
+        # Score each result in the database as the ``result_count``
+        # attribute, and order by it unless ordered otherwise.
+        sql, params = queryset._relevance(use_index)
+        return queryset.extra(select={"result_count": sql},
+                              select_params=params,
+                              order_by=["-result_count"])
+
+    def _term_filter(self, term, use_index=False):
         """
-        Ensure attributes are copied to subsequent queries.
+        Returns a ``Q`` object matching the given term in any of the
+        search fields. When using the search index, the instances
+        containing every stemmed word in the term are found in the
+        index, and terms with several words are then checked as a
+        phrase against the search fields of those instances only.
         """
-        for attr in ("_search_terms", "_search_fields", "_search_ordered"):
-            kwargs[attr] = getattr(self, attr)
-        return super(SearchableQuerySet, self)._clone(*args, **kwargs)
-
-    def order_by(self, *field_names):
+        contains = reduce(ior, [Q(**{"%s__icontains" % f: term})
+                                for f in self._search_fields.keys()])
+        words = index_terms(term) if use_index else None
+        if not words:
+            return contains
+        indexed = reduce(iand, [Q(pk__in=postings(self.model, word))
+                                for word in words])
+        if len(term.split()) > 1:
+            indexed &= contains
+        return indexed
+
+    def _relevance(self, use_index=False):
         """
-        Mark the filter as being ordered if search has occurred.
+        Returns the SQL and its params for scoring each result by the
+        weighted number of occurrences of the search terms in its
+        search fields, which is the total weight stored for its terms
+        when using the search index.
         """
-        if not self._search_ordered:
-            self._search_ordered = len(self._search_terms) > 0
-        return super(SearchableQuerySet, self).order_by(*field_names)
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        if use_index:
+            from mezzanine.core.models import SearchTerm
+            words = set()
+            for term in self._search_terms:
+                words.update(index_terms(term))
+            if not words:
+                return "0", []
+            content_types = index_content_types(self.model)
+            sql = ("(SELECT COALESCE(SUM(weight), 0) FROM %s WHERE "
+                   "object_pk = %s.%s AND content_type_id IN (%s) AND "
+                   "term IN (%s))" % (qn(SearchTerm._meta.db_table), table,
+                   qn(self.model._meta.pk.column),
+                   ", ".join([str(i) for i in content_types]),
+                   ", ".join(["%s"] * len(words))))
+            return sql, list(words)
+        scores = []
+        params = []
+        # MySQL's LENGTH counts bytes rather than characters.
+        length = "CHAR_LENGTH" if connection.vendor == "mysql" else "LENGTH"
+        for (name, weight) in self._search_fields.items():
+            try:
+                field, model, direct, m2m = \
+                    self.model._meta.get_field_by_name(name)
+            except FieldDoesNotExist:
+                continue
+            if not direct or m2m:
+                continue
+            # Fields inherited from a concrete parent model are
+            # selected from the parent's table.
+            column = "COALESCE(%s.%s, '')" % (
+                qn((model or self.model)._meta.db_table), qn(field.column))
+            # Occurrences are counted by the length of the field value
+            # with the term removed.
+            for term in [t for t in self._search_terms if t]:
+                scores.append("(%s(%s) - %s(REPLACE(LOWER(%s), %%s, ''))) "
+                              "* %s / %s" % (length, column, length, column,
+                                             int(weight), len(term)))
+                params.append(term)
+        if not scores:
+            return "0", []
+        return "(%s)" % " + ".join(scores), params
 
-    def iterator(self):
+    def _clone(self, *args, **kwargs):
         """
-        If search has occurred and no ordering has occurred, decorate
-        each result with the number of search terms so that it can be
-        sorted by the number of occurrence of terms.
+        Ensure attributes are copied to subsequent queries.
         """
-        results = super(SearchableQuerySet, self).iterator()
-        if self._search_terms and not self._search_ordered:
-            results = list(results)
-            for i, result in enumerate(results):
-                count = 0
-                for (field, weight) in self._search_fields.items():
-                    for term in self._search_terms:
-                        field_value = getattr(result, field)
-                        if field_value:
-                            count += field_value.lower().count(term) * weight
-                results[i].result_count = count
-            return iter(results)
-        return results
+        for attr in ("_search_terms", "_search_fields"):
+            kwargs[attr] = getattr(self, attr)
+        return super(SearchableQuerySet, self)._clone(*args, **kwargs)
 
 
 class SearchableManager(Manager):
@@ -248,25 +320,82 @@ class SearchableManager(Manager):
             models = [m for m in models if m not in parents]
         else:
             models = [self.model]
-        all_results = []
-
-        totalQueryset = models[0].objects.none()
-
         user = kwargs.pop("for_user", None)
+        querysets = []
         for model in models:
             try:
                 queryset = model.objects.published(for_user=user)
             except AttributeError:
                 queryset = model.objects.get_query_set()
-            totalQueryset = totalQueryset | queryset.search(*args, **kwargs)
-        
-        return totalQueryset
-        """
-            Removed the return value as list and return queryset instead.
-            This is required to apply filters on the search results.
-        """
-            #all_results.extend(queryset.search(*args, **kwargs))
-        #return sorted(all_results, key=lambda r: r.result_count, reverse=True)
+            querysets.append(queryset.search(*args, **kwargs))
+        if len(querysets) == 1:
+            return querysets[0]
+        return federated_search(querysets)
+
+
+class SearchResults(list):
+    """
+    List of results from ``federated_search``, with the time taken
+    to search each model in seconds stored in the ``timings`` dict.
+    """
+
+    def __init__(self, results, timings):
+        super(SearchResults, self).__init__(results)
+        self.timings = timings
+
+
+def _search_pool():
+    global _search_pool_instance
+    with _search_pool_lock:
+        if _search_pool_instance is None:
+            threads = settings.SEARCH_FEDERATED_THREADS
+            _search_pool_instance = ThreadPool(threads)
+    return _search_pool_instance
+
+
+def federated_search(querysets, limit=None):
+    """
+    Evaluates each of the search querysets for different models,
+    limited to the top ``SEARCH_FEDERATED_RESULTS`` results each, and
+    merges them into a single list ordered by ``result_count``. When
+    ``SEARCH_FEDERATED_THREADS`` is greater than one, the querysets
+    are evaluated concurrently on a pool of threads. The querysets
+    are built by the caller, since filtering by the current site
+    relies on the request, which is only available in its thread.
+    """
+    if limit is None:
+        limit = settings.SEARCH_FEDERATED_RESULTS
+
+    def evaluate(queryset):
+        start = time()
+        results = list(queryset[:limit])
+        return queryset.model, results, time() - start
+
+    def evaluate_in_thread(queryset):
+        # Connections opened by the pool's threads are closed, since
+        # they're not closed at the end of a request.
+        try:
+            return evaluate(queryset)
+        finally:
+            connection.close()
+
+    if settings.SEARCH_FEDERATED_THREADS > 1 and not settings.TESTING:
+        searched = _search_pool().map(evaluate_in_thread, querysets)
+        # Results loaded in other threads aren't tagged for the
+        # current request's cache entry when created.
+        for (model, results, _) in searched:
+            for result in results:
+                cache_tag_loaded(model, result)
+    else:
+        searched = map(evaluate, querysets)
+    # Each list is already ordered, so they're merged with a heap,
+    # using the model's position to break ties consistently.
+    ranked = [[(-(r.result_count or 0), i, j, r) for (j, r) in
+               enumerate(results)] for (i, (_, results, _)) in
+              enumerate(searched)]
+    results = [r[-1] for r in islice(merge(*ranked), limit)]
+    timings = dict([(model, duration) for (model, _, duration) in searched])
+    return SearchResults(results, timings)
 
 
 class CurrentSiteManager(DjangoCSM):
@@ -1,21 +1,34 @@
 
+from hashlib import md5
+import re
+import zlib
+
 from django.contrib import admin
 from django.contrib.auth import logout
-from django.contrib.redirects.models import Redirect
 from django.core.exceptions import MiddlewareNotUsed
 from django.core.urlresolvers import reverse
 from django.http import (HttpResponse, HttpResponseRedirect,
-                         HttpResponsePermanentRedirect, HttpResponseGone)
-from django.utils.cache import get_max_age
+                         HttpResponsePermanentRedirect, HttpResponseGone,
+                         HttpResponseNotModified)
+from django.utils.cache import get_max_age, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.utils.text import compress_string
 from django.template import Template, RequestContext
 from django.middleware.csrf import CsrfViewMiddleware, get_token
 
 from mezzanine.conf import settings
-from mezzanine.core.models import SitePermission
-from mezzanine.utils.cache import (cache_key_prefix, nevercache_token,
-                                   cache_get, cache_set, cache_installed)
+from mezzanine.utils.cache import (cache_key_prefix, cache_key_path,
+                                   cache_stat, nevercache_token,
+                                   nevercache_parts, LRUCache,
+                                   cache_get, cache_set, cache_installed,
+                                   cache_refresh, cache_versions,
+                                   cache_tag_versions,
+                                   CACHE_REFRESH_ENVIRON_KEY,
+                                   CACHE_BYPASS_PARAM)
 from mezzanine.utils.device import templates_for_device
-from mezzanine.utils.sites import current_site_id, templates_for_host
+from mezzanine.utils.sites import (current_site_id, templates_for_host,
+                                   user_site_ids)
+from mezzanine.utils.urls import redirect_for_path
 
 
 _deprecated = {
@@ -62,25 +75,23 @@ class SitePermissionMiddleware(object):
     """
     Marks the current user with a ``has_site_permission`` which is
     used in place of ``user.is_staff`` to achieve per-site staff
-    access.
+    access. The sites a staff user has access to are cached by
+    ``user_site_ids``.
     """
     def process_view(self, request, view_func, view_args, view_kwargs):
         has_site_permission = False
         if request.user.is_superuser:
             has_site_permission = True
         elif request.user.is_staff:
-            lookup = {"user": request.user, "sites": current_site_id()}
-            try:
-                SitePermission.objects.get(**lookup)
-            except SitePermission.DoesNotExist:
+            if int(current_site_id()) in user_site_ids(request.user):
+                has_site_permission = True
+            else:
                 admin_index = reverse("admin:index")
                 if request.path.startswith(admin_index):
                     logout(request)
                     view_func = admin.site.login
                     extra_context = {"no_site_permission": True}
                     return view_func(request, extra_context=extra_context)
-            else:
-                has_site_permission = True
         request.user.has_site_permission = has_site_permission
 
 
@@ -106,6 +117,87 @@ class TemplateForHostMiddleware(object):
         return response
 
 
+# Compiled templates for the content of ``nevercache`` tags, keyed by
+# a hash of their source, since the same few fragments are rendered
+# in the second phase for every cached page.
+_nevercache_templates = LRUCache(256)
+
+
+def nevercache_template(source):
+    """
+    Returns the compiled template for the content of a ``nevercache``
+    tag, only parsing it the first time it's seen by the process.
+    """
+    key = md5(source).hexdigest()
+    template = _nevercache_templates.get(key)
+    if template is None:
+        template = Template(source)
+        _nevercache_templates.set(key, template)
+    return template
+
+
+# Headers that are stored with responses cached by
+# ``UpdateCacheMiddleware``, and replayed when served from cache.
+CACHED_RESPONSE_HEADERS = ("Content-Type", "Content-Language", "Vary",
+                           "Last-Modified", "Cache-Control")
+
+accepts_gzip = re.compile(r"\bgzip\b").search
+
+
+def cache_record(response, versions):
+    """
+    Builds the entry stored in cache for a response - a tuple of its
+    status code, the headers to replay, its ETag, its gzipped content,
+    whether the content contains ``nevercache`` parts that need
+    rendering per request, and the tag versions it was rendered with.
+    A strong ETag is generated from the content unless the response
+    provides its own, or contains ``nevercache`` parts which make it
+    differ per request.
+    """
+    content = response.content
+    has_nevercache = nevercache_token() in content
+    headers = [(name, response[name]) for name in CACHED_RESPONSE_HEADERS
+               if response.has_header(name)]
+    etag = None
+    if response.has_header("ETag"):
+        etag = response["ETag"]
+    elif not has_nevercache:
+        etag = quote_etag(md5(content).hexdigest())
+    return (response.status_code, headers, etag, compress_string(content),
+            has_nevercache, versions)
+
+
+def response_from_cache_record(request, record):
+    """
+    Builds the response for a cache entry created by ``cache_record``.
+    A matching ``If-None-Match`` header gets a 304 response without
+    touching the content, and the gzipped content is sent as is to
+    clients that accept it, unless it contains ``nevercache`` parts
+    that still need rendering.
+    """
+    status, headers, etag, content, has_nevercache = record[:5]
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if etag and if_none_match:
+        if_none_match = [quote_etag(e) for e in parse_etags(if_none_match)]
+        if etag in if_none_match or '"*"' in if_none_match:
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+    accept_encoding = request.META.get("HTTP_ACCEPT_ENCODING", "")
+    if not has_nevercache and accepts_gzip(accept_encoding):
+        response = HttpResponse(content, status=status)
+        response["Content-Encoding"] = "gzip"
+    else:
+        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        response = HttpResponse(content, status=status)
+    for (name, value) in headers:
+        response[name] = value
+    if etag:
+        response["ETag"] = etag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
 class UpdateCacheMiddleware(object):
     """
     Response phase for Mezzanine's cache middleware. Handles caching
@@ -128,8 +220,22 @@ class UpdateCacheMiddleware(object):
         if timeout is None:
             timeout = settings.CACHE_MIDDLEWARE_SECONDS
         if anon and valid_status and marked_for_update and timeout:
-            cache_key = cache_key_prefix(request) + request.get_full_path()
-            _cache_set = lambda r: cache_set(cache_key, r.content, timeout)
+            cache_key = cache_key_prefix(request) + cache_key_path(request)
+
+            # The response is stored with the versions of the tags
+            # for each model instance loaded while rendering it, so
+            # it can be invalidated when any of those instances change,
+            # and isn't stored if they changed while it was rendered.
+            # Responses already encoded by other middleware (eg gzip)
+            # are specific to the client, so aren't stored.
+            def _cache_set(r):
+                if r.has_header("Content-Encoding"):
+                    return
+                versions = cache_tag_versions(request)
+                if versions is not None:
+                    record = cache_record(r, versions)
+                    cache_set(cache_key, record, timeout)
+
             if callable(getattr(response, "render", None)):
                 response.add_post_render_callback(_cache_set)
             else:
@@ -139,8 +245,13 @@ class UpdateCacheMiddleware(object):
         # content. Split on the delimiter the ``nevercache`` tag
         # wrapped its contents in, and render only the content
         # enclosed by it, to avoid possible template code injection.
-        parts = response.content.split(nevercache_token())
-        if response["content-type"].startswith("text") and len(parts) > 1:
+        # Not modified responses have no content or content type.
+        parts = None
+        if (response.status_code != 304 and
+            response.get("Content-Type", "").startswith("text") and
+            not response.has_header("Content-Encoding")):
+            parts = nevercache_parts(response.content, nevercache_token())
+        if parts:
             # Restore csrf token from cookie - check the response
             # first as it may be being set for the first time.
             csrf_token = None
@@ -156,7 +267,8 @@ class UpdateCacheMiddleware(object):
             context = RequestContext(request)
             for i, part in enumerate(parts):
                 if i % 2:
-                    part = Template(part).render(context).encode("utf-8")
+                    template = nevercache_template(part)
+                    part = template.render(context).encode("utf-8")
                 parts[i] = part
             response.content = "".join(parts)
             response["Content-Length"] = len(response.content)
@@ -175,13 +287,49 @@ class FetchFromCacheMiddleware(object):
     response, Django will not execute the next middlewares, but we really
     need ``CsrfViewMiddleware`` to run before ``UpdateCacheMiddleware`` to
     make sure a valid csrf token exist.
+
+    When ``CACHE_STALE_WHILE_REVALIDATE`` is ``True``, stale entries
+    are served while a copy of the request is run again on a
+    background thread to regenerate the entry. That copy is marked
+    with ``CACHE_REFRESH_ENVIRON_KEY``, and skips the cache lookup.
+
+    Entries are also treated as missing once any of the model
+    instances they were tagged with by ``UpdateCacheMiddleware``
+    have changed. See ``response_from_cache_record`` for how the
+    response is built from the cache entry.
+
+    Cache keys use the normalised querystring from ``cache_key_path``.
+    Requests containing the querystring parameter added by
+    ``add_cache_bypass`` skip the cache lookup, and replace the entry
+    stored under the normalised key.
     """
 
     def process_request(self, request):
         if (cache_installed() and request.method == "GET" and
             not request.user.is_authenticated()):
-            cache_key = cache_key_prefix(request) + request.get_full_path()
-            response = cache_get(cache_key)
+            cache_key = cache_key_prefix(request) + cache_key_path(request)
+            if (request.META.get(CACHE_REFRESH_ENVIRON_KEY) or
+                CACHE_BYPASS_PARAM in request.GET):
+                cache_stat("bypasses")
+                response = None
+            else:
+                refresh = lambda: cache_refresh(request.META)
+                response = cache_get(cache_key, refresh)
+                if response is None:
+                    cache_stat("misses")
+                # Entries stored in an older format are treated as
+                # missing.
+                elif not isinstance(response, tuple) or len(response) != 6:
+                    cache_stat("misses")
+                    response = None
+                else:
+                    versions = response[-1]
+                    if (versions and
+                        cache_versions(versions.keys()) != versions):
+                        cache_stat("invalidations")
+                        response = None
+                    else:
+                        cache_stat("hits")
             if response is None:
                 request._update_cache = True
             else:
@@ -190,7 +338,7 @@ class FetchFromCacheMiddleware(object):
                     csrf_mw = CsrfViewMiddleware()
                     csrf_mw.process_view(request, lambda x: None, None, None)
                     get_token(request)
-                return HttpResponse(response)
+                return response_from_cache_record(request, response)
 
 
 class SSLRedirectMiddleware(object):
@@ -221,7 +369,10 @@ class SSLRedirectMiddleware(object):
 class RedirectFallbackMiddleware(object):
     """
     Port of Django's ``RedirectFallbackMiddleware`` that uses
-    Mezzanine's approach for determining the current site.
+    Mezzanine's approach for determining the current site, and
+    ``redirect_for_path`` for finding redirects without querying the
+    database. Old paths ending in ``*`` redirect every path that
+    starts with them.
     """
 
     def __init__(self):
@@ -230,17 +381,10 @@ class RedirectFallbackMiddleware(object):
 
     def process_response(self, request, response):
         if response.status_code == 404:
-            lookup = {
-                "site_id": current_site_id(),
-                "old_path": request.get_full_path(),
-            }
-            try:
-                redirect = Redirect.objects.get(**lookup)
-            except Redirect.DoesNotExist:
-                pass
-            else:
-                if not redirect.new_path:
-                    response = HttpResponseGone()
-                else:
-                    response = HttpResponseRedirect(redirect.new_path)
+            path = request.get_full_path()
+            new_path = redirect_for_path(current_site_id(), path)
+            if new_path == "":
+                response = HttpResponseGone()
+            elif new_path is not None:
+                response = HttpResponseRedirect(new_path)
         return response
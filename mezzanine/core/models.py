@@ -1,21 +1,30 @@
 from django.contrib.contenttypes.generic import GenericForeignKey
+from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.db.models import get_model
 from django.db.models.base import ModelBase
-from django.db.models.signals import post_save
+from django.db.models.signals import class_prepared, m2m_changed
+from django.db.models.signals import post_init, post_save, post_delete
 from django.template.defaultfilters import truncatewords_html
 from django.utils.html import strip_tags
 from django.utils.timesince import timesince
 from django.utils.timezone import now
 from django.utils.translation import ugettext, ugettext_lazy as _
 
+from mezzanine.conf import settings
 from mezzanine.core.fields import RichTextField
 from mezzanine.core.managers import DisplayableManager, CurrentSiteManager
+from mezzanine.core.search import search_index_changed, search_index_deleted
+from mezzanine.core.search import typeahead_changed
 from mezzanine.generic.fields import KeywordsField
+from mezzanine.utils.cache import cache_installed, cache_tag_changed
+from mezzanine.utils.cache import cache_tag_loaded
 from mezzanine.utils.html import TagCloser
 from mezzanine.utils.models import base_concrete_model, get_user_model_name
-from mezzanine.utils.sites import current_site_id
-from mezzanine.utils.urls import admin_url, slugify
+from mezzanine.utils.sites import current_site_id, site_changed
+from mezzanine.utils.sites import site_permission_changed
+from mezzanine.utils.urls import admin_url, redirect_changed, slugify
 
 
 user_model_name = get_user_model_name()
@@ -481,17 +490,82 @@ class SitePermission(models.Model):
         verbose_name_plural = _("Site permissions")
 
 
+class SearchTerm(models.Model):
+    """
+    Entry in the search index used when the ``SEARCH_USE_INDEX``
+    setting is ``True``, for a stemmed word that occurs in the search
+    fields of a model instance, with the total weight of its
+    occurrences. See ``mezzanine.core.search``.
+    """
+
+    term = models.CharField(max_length=100, db_index=True)
+    content_type = models.ForeignKey("contenttypes.ContentType")
+    object_pk = models.IntegerField(db_index=True)
+    weight = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name = _("Search term")
+        verbose_name_plural = _("Search terms")
+
+
 def create_site_permission(sender, **kw):
-    sender_name = "%s.%s" % (sender._meta.app_label, sender._meta.object_name)
-    if sender_name.lower() != user_model_name.lower():
-        return
     user = kw["instance"]
     if user.is_staff and not user.is_superuser:
         perm, created = SitePermission.objects.get_or_create(user=user)
         if created or perm.sites.count() < 1:
             perm.sites.add(current_site_id())
 
+
+def connect_site_permission(sender, **kwargs):
+    """
+    Connects ``create_site_permission`` to saves of the user model
+    only, once the user model has been created.
+    """
+    sender_name = "%s.%s" % (sender._meta.app_label, sender._meta.object_name)
+    if sender_name.lower() == user_model_name.lower():
+        post_save.connect(create_site_permission, sender=sender,
+                          dispatch_uid="create_site_permission")
+
 # We don't specify the user model here, because with 1.5's custom
-# user models, everything explodes. So we check the name of it in
-# the signal.
-post_save.connect(create_site_permission)
+# user models, everything explodes. So we connect to the user model
+# when it's created, or now if it already has been.
+class_prepared.connect(connect_site_permission)
+user_model = get_model(*user_model_name.split("."), seed_cache=False,
+                       only_installed=False)
+if user_model is not None:
+    connect_site_permission(user_model)
+
+# Expiry of the site IDs cached for each staff user.
+post_save.connect(site_permission_changed, sender=SitePermission)
+post_delete.connect(site_permission_changed, sender=SitePermission)
+m2m_changed.connect(site_permission_changed,
+                    sender=SitePermission.sites.through)
+
+# Tagging of cached responses with the model instances they contain,
+# for models that are checked for inside the signal handlers. Loading
+# instances is only tracked when the cache middleware is installed,
+# since the handler runs for every model instance created.
+if cache_installed():
+    post_init.connect(cache_tag_loaded)
+post_save.connect(cache_tag_changed)
+post_delete.connect(cache_tag_changed)
+
+# Updates to the search index for models with a SearchableManager,
+# which are checked for inside the signal handlers.
+post_save.connect(search_index_changed)
+post_delete.connect(search_index_deleted)
+
+# Expiry of the typeahead index for each site, for models that are
+# checked for inside the signal handler.
+post_save.connect(typeahead_changed)
+post_delete.connect(typeahead_changed)
+
+# Expiry of the domain to site ID mapping used by current_site_id.
+post_save.connect(site_changed, sender=Site)
+post_delete.connect(site_changed, sender=Site)
+
+# Expiry of the redirects used by RedirectFallbackMiddleware.
+if "django.contrib.redirects" in settings.INSTALLED_APPS:
+    from django.contrib.redirects.models import Redirect
+    post_save.connect(redirect_changed, sender=Redirect)
+    post_delete.connect(redirect_changed, sender=Redirect)
@@ -0,0 +1,670 @@
+"""
+Search index used by ``SearchableQuerySet`` when the
+``SEARCH_USE_INDEX`` setting is ``True``. Each instance of a model
+with a ``SearchableManager`` is stored as a ``SearchTerm`` for each
+stemmed word in its search fields, along with the total weight of the
+word's occurrences, so that searches can query the index rather than
+scanning each search field with ``icontains``.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import timedelta
+import re
+from threading import Lock
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.db.models import get_model, get_models
+from django.db.models.signals import post_delete
+from django.utils.timezone import now
+
+from mezzanine.conf import settings
+
+
+# Longest term stored in the index, matching ``SearchTerm.term``.
+MAX_TERM_LENGTH = 100
+
+# Number of terms inserted per query by ``index_instances``, which
+# keeps inserts within the query parameter limit for SQLite.
+INDEX_BATCH_SIZE = 200
+
+words = re.compile(r"\w+", re.UNICODE).findall
+vowels = re.compile("[aeiouy]").search
+_stop_words = (None, None)
+
+
+def stem(word):
+    """
+    Light suffix-stripping stemmer for English, covering plurals and
+    the ``-ed`` and ``-ing`` forms (step 1 of the Porter stemmer), so
+    that eg "vendors" and "vendor" are indexed as the same term. The
+    same stemming is applied to search queries.
+    """
+    if len(word) <= 3 or not word.isalpha():
+        return word
+    if word.endswith("sses"):
+        word = word[:-2]
+    elif word.endswith("ies"):
+        word = word[:-3] + "y"
+    elif word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        word = word[:-1]
+    if word.endswith("eed"):
+        if vowels(word[:-3]):
+            word = word[:-1]
+        return word
+    for suffix in ("ed", "ing"):
+        base = word[:-len(suffix)]
+        if word.endswith(suffix) and len(base) >= 3 and vowels(base):
+            if (base[-1] == base[-2] and base[-1] not in "lsz" and
+                not vowels(base[-1])):
+                base = base[:-1]
+            return base
+    return word
+
+
+def index_terms(text):
+    """
+    Returns the list of stemmed words in the given text, excluding
+    words in the ``STOP_WORDS`` setting.
+    """
+    global _stop_words
+    if _stop_words[0] is not settings.STOP_WORDS:
+        _stop_words = (settings.STOP_WORDS, frozenset(settings.STOP_WORDS))
+    stop_words = _stop_words[1]
+    return [stem(word)[:MAX_TERM_LENGTH] for word in words(text.lower())
+            if word not in stop_words]
+
+
+def searchable_fields(model):
+    """
+    Returns the search fields mapped to weights for the model, if it
+    has a ``SearchableManager``, otherwise an empty dict.
+    """
+    manager = getattr(model, "_default_manager", None)
+    get_search_fields = getattr(manager, "get_search_fields", None)
+    if get_search_fields is None:
+        return {}
+    return get_search_fields()
+
+
+def index_weights(instance):
+    """
+    Returns a dict mapping each term in the instance's search fields
+    to the weighted number of times it occurs.
+    """
+    weights = {}
+    for (field, weight) in searchable_fields(instance.__class__).items():
+        value = getattr(instance, field, None)
+        if value:
+            for term in index_terms(unicode(value)):
+                weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def index_instance(instance):
+    """
+    Updates the terms stored in the search index for the instance,
+    only writing the terms that have been added, removed, or whose
+    weights have changed since it was last indexed.
+    """
+    from mezzanine.core.models import SearchTerm
+    content_type = ContentType.objects.get_for_model(instance)
+    lookup = {"content_type": content_type, "object_pk": instance.pk}
+    weights = index_weights(instance)
+    removed = []
+    changed = {}
+    stored = SearchTerm.objects.filter(**lookup)
+    for (term_id, term, weight) in stored.values_list("id", "term", "weight"):
+        new_weight = weights.pop(term, None)
+        if new_weight is None:
+            removed.append(term_id)
+        elif new_weight != weight:
+            changed.setdefault(new_weight, []).append(term_id)
+    if removed:
+        SearchTerm.objects.filter(id__in=removed).delete()
+    for (weight, term_ids) in changed.items():
+        SearchTerm.objects.filter(id__in=term_ids).update(weight=weight)
+    SearchTerm.objects.bulk_create([SearchTerm(term=term, weight=weight,
+                                               **lookup)
+                                    for (term, weight) in weights.items()])
+
+
+def index_instances(model, instances):
+    """
+    Replaces the terms stored in the search index for a sequence of
+    instances of the model, with a single delete and inserts in
+    batches of ``INDEX_BATCH_SIZE``. Used when rebuilding the index.
+    """
+    from mezzanine.core.models import SearchTerm
+    content_type = ContentType.objects.get_for_model(model)
+    SearchTerm.objects.filter(content_type=content_type,
+        object_pk__in=[instance.pk for instance in instances]).delete()
+    terms = []
+    for instance in instances:
+        for (term, weight) in index_weights(instance).items():
+            terms.append(SearchTerm(term=term, weight=weight,
+                                    content_type=content_type,
+                                    object_pk=instance.pk))
+    for i in range(0, len(terms), INDEX_BATCH_SIZE):
+        SearchTerm.objects.bulk_create(terms[i:i + INDEX_BATCH_SIZE])
+
+
+def unindex_instance(instance):
+    """
+    Removes the terms stored in the search index for the instance.
+    """
+    from mezzanine.core.models import SearchTerm
+    content_type = ContentType.objects.get_for_model(instance)
+    SearchTerm.objects.filter(content_type=content_type,
+                              object_pk=instance.pk).delete()
+
+
+def index_content_types(model):
+    """
+    Returns the IDs of the content types whose terms are searched for
+    the model, which are the model's own along with those of the
+    models that subclass it, since instances are indexed for their
+    most specific model.
+    """
+    return [ContentType.objects.get_for_model(m).id for m in get_models()
+            if issubclass(m, model)]
+
+
+def postings(model, term):
+    """
+    Returns a queryset of the primary keys for instances of the model
+    that contain the given stemmed term, for use as a subquery.
+    """
+    from mezzanine.core.models import SearchTerm
+    content_types = index_content_types(model)
+    return SearchTerm.objects.filter(term=term,
+        content_type__in=content_types).values("object_pk")
+
+
+def search_index_changed(sender, instance, **kwargs):
+    """
+    Signal handler for any model being saved, that updates the search
+    index for instances of models with a ``SearchableManager``. This
+    includes the ``KeywordsField`` string being updated when keywords
+    are assigned, which saves the instance. Instances are indexed for
+    their content model where they have one, as with ``Page``.
+    """
+    if not settings.SEARCH_USE_INDEX or not searchable_fields(sender):
+        return
+    content_model = getattr(instance, "content_model", None)
+    if content_model and content_model != sender._meta.object_name.lower():
+        instance = instance.get_content_model() or instance
+    index_instance(instance)
+
+
+def search_index_deleted(sender, instance, **kwargs):
+    """
+    Signal handler for any model being deleted, that removes instances
+    of models with a ``SearchableManager`` from the search index.
+    """
+    if settings.SEARCH_USE_INDEX and searchable_fields(sender):
+        unindex_instance(instance)
+
+
+# Models whose titles are suggested by ``typeahead``, with the type
+# given for each suggestion.
+TYPEAHEAD_MODELS = (
+    ("blog.BlogPost", "vendor"),
+    ("blog.BlogCategory", "category"),
+    ("generic.Keyword", "keyword"),
+)
+
+# Models whose titles are matched by ``fuzzy_search``.
+TRIGRAM_MODELS = ("blog.BlogPost", "generic.Keyword")
+
+
+class TypeaheadIndex(object):
+    """
+    Prefix index of titles, given as a sequence of ``(key, suggestion)``
+    pairs with each suggestion a dict with a ``title`` key. Each title
+    is stored once for the start of each of its words, in a sorted list
+    that's searched with ``bisect``, so that suggestions are found for
+    the start of any word in a title. Suggestions can be replaced or
+    removed by key with ``update``.
+    """
+
+    def __init__(self, suggestions):
+        self.suggestions = dict(suggestions)
+        entries = []
+        for (key, suggestion) in self.suggestions.items():
+            entries.extend(self._entries(key, suggestion))
+        entries.sort()
+        self.words = [words for (words, key) in entries]
+        self.keys = [key for (words, key) in entries]
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.suggestions)
+
+    def _entries(self, key, suggestion):
+        """
+        Returns the title from the start of each of its words, with
+        the suggestion's key.
+        """
+        title = " ".join(suggestion["title"].lower().split())
+        entries = []
+        start = 0
+        for word in title.split(" "):
+            entries.append((title[start:], key))
+            start += len(word) + 1
+        return entries
+
+    def update(self, key, suggestion=None):
+        """
+        Replaces the suggestion for the given key, or removes it if
+        ``suggestion`` is ``None``.
+        """
+        with self.lock:
+            previous = self.suggestions.pop(key, None)
+            if previous is not None:
+                for (words, key) in self._entries(key, previous):
+                    i = bisect_left(self.words, words)
+                    while self.keys[i] != key:
+                        i += 1
+                    del self.words[i]
+                    del self.keys[i]
+            if suggestion is not None:
+                self.suggestions[key] = suggestion
+                for (words, key) in self._entries(key, suggestion):
+                    i = bisect_right(self.words, words)
+                    self.words.insert(i, words)
+                    self.keys.insert(i, key)
+
+    def get(self, prefix, limit=10):
+        """
+        Returns up to ``limit`` suggestions with a word in their title
+        starting with the given prefix, ordered alphabetically by the
+        title from the matching word onwards.
+        """
+        prefix = " ".join(prefix.lower().split())
+        if not prefix:
+            return []
+        found = []
+        seen = set()
+        with self.lock:
+            i = bisect_left(self.words, prefix)
+            while (i < len(self.words) and len(found) < limit and
+                   self.words[i].startswith(prefix)):
+                key = self.keys[i]
+                if key not in seen:
+                    seen.add(key)
+                    found.append(self.suggestions[key])
+                i += 1
+        return found
+
+
+def _category_parent_slugs(category_ids=None):
+    """
+    Returns the slug of the first parent category by title for each
+    blog category, or for those with the given IDs, with one query.
+    """
+    category_model = get_model("blog", "BlogCategory")
+    links = category_model.parent_category.through.objects.all()
+    if category_ids is not None:
+        links = links.filter(blogcategory__in=category_ids)
+    links = links.order_by("blogparentcategory__title")
+    slugs = {}
+    for (category_id, slug) in links.values_list("blogcategory",
+                                                 "blogparentcategory__slug"):
+        slugs.setdefault(category_id, slug)
+    return slugs
+
+
+def _typeahead_url(instance, parent_slugs=None):
+    """
+    Returns the URL for a suggestion, which for keywords is the list
+    of blog posts tagged with the keyword. Blog categories are given
+    the vendor listing for their first parent category, which is read
+    from the database (or the given parent slugs) rather than the
+    category tree, since the tree may already be stored on the request
+    from before the category changed.
+    """
+    try:
+        name = instance._meta.object_name
+        if name == "Keyword":
+            return reverse("blog_post_list_tag", args=(instance.slug,))
+        if name == "BlogCategory":
+            if parent_slugs is None:
+                parent_slugs = _category_parent_slugs([instance.id])
+            kwargs = {"parent_category_slug": parent_slugs[instance.id],
+                      "sub_category_slug": instance.slug}
+            return reverse("get_vendors", kwargs=kwargs)
+        return instance.get_absolute_url()
+    except (AttributeError, IndexError, KeyError, NoReverseMatch):
+        return ""
+
+
+def _published(instance):
+    """
+    Returns ``True`` if the instance would be returned by its model's
+    ``published`` manager method for a non-staff user, or if its model
+    has no publishing fields.
+    """
+    from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
+    if not hasattr(instance, "status"):
+        return True
+    current = now()
+    return (instance.status == CONTENT_STATUS_PUBLISHED and
+            (instance.publish_date is None or
+             instance.publish_date <= current) and
+            (instance.expiry_date is None or
+             instance.expiry_date >= current))
+
+
+def _due(instance):
+    """
+    Returns the instance's publish or expiry date if it's within
+    ``CACHE_MIDDLEWARE_SECONDS``, the longest the ``TypeaheadIndex``
+    is kept for.
+    """
+    current = now()
+    latest = current + timedelta(seconds=settings.CACHE_MIDDLEWARE_SECONDS)
+    for name in ("publish_date", "expiry_date"):
+        date = getattr(instance, name, None)
+        if date is not None and current < date <= latest:
+            return date
+    return None
+
+
+def _typeahead_suggestion(instance, suggestion_type, parent_slugs=None):
+    return {"title": instance.title,
+            "url": _typeahead_url(instance, parent_slugs),
+            "type": suggestion_type}
+
+
+def _typeahead_suggestions():
+    """
+    Returns the suggestions for the current site's published blog
+    posts, blog categories and keywords, keyed by model name and ID.
+    """
+    suggestions = []
+    for (name, suggestion_type) in TYPEAHEAD_MODELS:
+        model = get_model(*name.split(".", 1))
+        if model is None:
+            continue
+        try:
+            instances = model.objects.published()
+        except AttributeError:
+            instances = model.objects.all()
+        parent_slugs = None
+        if name == "blog.BlogCategory":
+            parent_slugs = _category_parent_slugs()
+        for instance in instances:
+            suggestion = _typeahead_suggestion(instance, suggestion_type,
+                                               parent_slugs)
+            suggestions.append(((name, instance.pk), suggestion))
+    return suggestions
+
+
+def _typeahead_timeout():
+    """
+    Returns the number of seconds until the next publish or expiry
+    date of any instance of the models in ``TYPEAHEAD_MODELS``, when
+    the ``TypeaheadIndex`` is loaded again since the instance is
+    published or expires without being saved.
+    """
+    from mezzanine.utils.cache import publish_cache_timeout
+    timeout = settings.CACHE_MIDDLEWARE_SECONDS
+    for (name, suggestion_type) in TYPEAHEAD_MODELS:
+        model = get_model(*name.split(".", 1))
+        if model is not None and hasattr(model.objects, "published"):
+            timeout = min(timeout, publish_cache_timeout(model))
+    return timeout
+
+
+def _update_index(index, changes):
+    for (key, value) in changes:
+        index.update(key, value)
+
+
+def _typeahead_index():
+    """
+    Returns the ``TypeaheadIndex`` for the current site, kept in the
+    process via ``cache_snapshot`` and updated in place with the
+    changes recorded by ``typeahead_changed``.
+    """
+    from mezzanine.utils.cache import cache_snapshot
+    from mezzanine.utils.sites import current_site_id
+    name = "typeahead.%s" % current_site_id()
+    load = lambda: TypeaheadIndex(_typeahead_suggestions())
+    return cache_snapshot(name, load, _update_index, _typeahead_timeout)
+
+
+def typeahead(prefix, limit=10):
+    """
+    Returns suggestions for the titles on the current site that start
+    with the given prefix.
+    """
+    return _typeahead_index().get(prefix, limit)
+
+
+def typeahead_changed(sender, instance, **kwargs):
+    """
+    Signal handler for any model being saved or deleted, that records
+    the instance's suggestion for the ``TypeaheadIndex`` of its site
+    for models in ``TYPEAHEAD_MODELS``, and its title for the
+    ``TrigramIndex`` of its site for models in ``TRIGRAM_MODELS``, so
+    that each process updates its indexes in place. Nothing is
+    recorded when the suggestion is unchanged, such as when a blog
+    post is saved for a new rating or review.
+    """
+    from mezzanine.utils.cache import bump_cache_version, cache_installed
+    from mezzanine.utils.cache import cache_snapshot_change
+    from mezzanine.utils.sites import current_site_id
+    opts = sender._meta
+    name = "%s.%s" % (opts.app_label, opts.object_name)
+    suggestion_type = dict(TYPEAHEAD_MODELS).get(name)
+    if (suggestion_type is None and name not in TRIGRAM_MODELS or
+            not cache_installed()):
+        return
+    deleted = kwargs.get("signal") is post_delete
+    key = (name, instance.pk)
+    suggestion = None
+    if not deleted and _published(instance):
+        suggestion = _typeahead_suggestion(instance, suggestion_type)
+    # The suggestion can only be compared with the process' index
+    # when the instance belongs to the current site, otherwise the
+    # change is always recorded.
+    previous = None
+    current = str(instance.site_id) == str(current_site_id())
+    if current and suggestion_type is not None:
+        previous = _typeahead_index().suggestions.get(key)
+    if suggestion_type is not None and (not current or
+                                        previous != suggestion):
+        cache_snapshot_change("typeahead.%s" % instance.site_id,
+                              (key, suggestion))
+    # An instance due to be published or expire before the index is
+    # next loaded again reloads it now, so that its timeout is reset.
+    if not deleted and _due(instance) is not None:
+        bump_cache_version("typeahead.%s" % instance.site_id)
+    if name in TRIGRAM_MODELS:
+        title = None if deleted else instance.title
+        if previous is None or previous["title"] != title:
+            cache_snapshot_change("trigrams.%s" % instance.site_id,
+                                  (key, title))
+
+
+def typeahead_categories_changed(sender, instance, **kwargs):
+    """
+    Signal handler for the parent categories of blog categories
+    changing from either side, and for parent categories being saved
+    or deleted, all of which change the URLs of the categories'
+    suggestions. The changed categories are passed to
+    ``typeahead_changed``, while the ``TypeaheadIndex`` for the site
+    is loaded again when a parent category is changed or deleted, or
+    its categories are cleared, since the categories aren't known.
+    """
+    from mezzanine.utils.cache import bump_cache_version, cache_installed
+    action = kwargs.get("action")
+    if (not cache_installed() or kwargs.get("created") or
+            (action and not action.startswith("post_"))):
+        return
+    category_model = get_model("blog", "BlogCategory")
+    if isinstance(instance, category_model):
+        typeahead_changed(category_model, instance)
+    elif kwargs.get("pk_set"):
+        categories = category_model.objects.filter(id__in=kwargs["pk_set"])
+        for category in categories:
+            typeahead_changed(category_model, category)
+    else:
+        bump_cache_version("typeahead.%s" % instance.site_id)
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams for the words in the given text, with
+    each word padded by two spaces before it and one after, so that
+    matching the start of words counts for more than their end.
+    """
+    grams = set()
+    for word in words(text.lower()):
+        word = "  %s " % word
+        grams.update([word[i:i + 3] for i in range(len(word) - 2)])
+    return grams
+
+
+class TrigramIndex(object):
+    """
+    Index of titles by their trigrams, given as a sequence of
+    ``(title, value)`` pairs, for finding titles similar to some text.
+    Positions of the titles containing each trigram are stored
+    together in a single array, with the sorted trigrams searched with
+    ``bisect`` to find their offsets in it. Titles replaced or removed
+    with ``update`` are marked as removed in the array, with titles
+    added by it kept in a dict of trigrams.
+    """
+
+    def __init__(self, entries):
+        self.values = []
+        self.counts = array("H")
+        self.removed = set()
+        self.added = {}
+        self.lock = Lock()
+        self._positions = None
+        positions = {}
+        for (title, value) in entries:
+            self._add(title, value, positions)
+        self.grams = sorted(positions)
+        self.offsets = array("I", [0])
+        self.positions = array("I")
+        for gram in self.grams:
+            self.positions.extend(positions[gram])
+            self.offsets.append(len(self.positions))
+
+    def __len__(self):
+        return len(self.values) - len(self.removed)
+
+    def _add(self, title, value, positions):
+        grams = trigrams(title)
+        if grams:
+            for gram in grams:
+                positions.setdefault(gram, []).append(len(self.values))
+            self.values.append(value)
+            self.counts.append(min(len(grams), 0xffff))
+
+    def update(self, value, title=None):
+        """
+        Replaces the title for the given value, or removes it if
+        ``title`` is ``None``.
+        """
+        with self.lock:
+            if self._positions is None:
+                self._positions = dict([(v, position) for (position, v)
+                                        in enumerate(self.values)])
+            position = self._positions.pop(value, None)
+            if position is not None:
+                self.removed.add(position)
+            if title is not None:
+                position = len(self.values)
+                self._add(title, value, self.added)
+                if len(self.values) > position:
+                    self._positions[value] = position
+
+    def get(self, text, threshold):
+        """
+        Returns ``(similarity, value)`` pairs for the titles whose
+        similarity to the given text is at least ``threshold``, most
+        similar first. Similarity is the number of trigrams shared
+        over the number of trigrams in either, from 0 to 1.
+        """
+        grams = trigrams(text)
+        shared = {}
+        with self.lock:
+            for gram in grams:
+                i = bisect_left(self.grams, gram)
+                if i < len(self.grams) and self.grams[i] == gram:
+                    start, end = self.offsets[i], self.offsets[i + 1]
+                    for position in self.positions[start:end]:
+                        shared[position] = shared.get(position, 0) + 1
+                for position in self.added.get(gram, ()):
+                    shared[position] = shared.get(position, 0) + 1
+            for position in self.removed:
+                shared.pop(position, None)
+            matches = []
+            for (position, count) in shared.items():
+                total = len(grams) + self.counts[position] - count
+                similarity = float(count) / total
+                if similarity >= threshold:
+                    matches.append((similarity, position))
+            matches.sort(key=lambda match: (-match[0], match[1]))
+            return [(score, self.values[position])
+                    for (score, position) in matches]
+
+
+def _trigram_entries():
+    """
+    Returns the titles of the current site's instances of each model
+    in ``TRIGRAM_MODELS``, with the model's name and the instance's ID.
+    """
+    entries = []
+    for name in TRIGRAM_MODELS:
+        model = get_model(*name.split(".", 1))
+        if model is not None:
+            for (title, pk) in model.objects.values_list("title", "id"):
+                entries.append((title, (name, pk)))
+    return entries
+
+
+def fuzzy_search(query, threshold=None):
+    """
+    Returns the IDs of blog posts whose titles or keywords are similar
+    to the query, most similar first, using a ``TrigramIndex`` kept in
+    the process via ``cache_snapshot`` and updated in place with the
+    changes recorded by ``typeahead_changed``. Used when searching for
+    the query returns no results, to allow for misspellings. Blog
+    posts matched by keyword are ranked with the keyword's similarity.
+    """
+    from mezzanine.utils.cache import cache_snapshot
+    from mezzanine.utils.sites import current_site_id
+    if threshold is None:
+        threshold = settings.SEARCH_FUZZY_THRESHOLD
+    name = "trigrams.%s" % current_site_id()
+    load = lambda: TrigramIndex(_trigram_entries())
+    matches = cache_snapshot(name, load, _update_index).get(query, threshold)
+    if not matches:
+        return []
+    keywords = {}
+    for (similarity, (name, pk)) in matches:
+        if name == "generic.Keyword":
+            keywords[pk] = similarity
+    similarities = {}
+    if keywords:
+        from mezzanine.generic.models import AssignedKeyword
+        blog_post = get_model("blog", "BlogPost")
+        content_type = ContentType.objects.get_for_model(blog_post)
+        assigned = AssignedKeyword.objects.filter(content_type=content_type,
+                                                  keyword__in=keywords.keys())
+        for (keyword_id, pk) in assigned.values_list("keyword", "object_pk"):
+            similarities[pk] = max(similarities.get(pk, 0),
+                                   keywords[keyword_id])
+    for (similarity, (name, pk)) in matches:
+        if name == "blog.BlogPost":
+            similarities[pk] = max(similarities.get(pk, 0), similarity)
+    ranked = sorted(similarities.items(), key=lambda item: (-item[1], item[0]))
+    return [pk for (pk, similarity) in ranked]
@@ -224,8 +224,10 @@ def metablock(parsed):
 def pagination_for(context, current_page, page_var="page"):
     """
     Include the pagination template and data for persisting querystring in
-    pagination links.
+    pagination links. Pages from ``paginate_keyset`` give their own
+    querystring param for the cursors used in place of page numbers.
     """
+    page_var = getattr(current_page, "page_var", page_var)
     querystring = context["request"].GET.copy()
     if page_var in querystring:
         del querystring[page_var]
@@ -1,46 +1,140 @@
 
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
 import os
 from shutil import rmtree
+from tempfile import mkdtemp
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+from threading import Event
+from time import sleep, time
 from urlparse import urlparse
 from uuid import uuid4
 
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.contenttypes.models import ContentType
 from django.core import mail
-from django.core.urlresolvers import reverse
-from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.conf.urls import patterns, url
+from django.core.urlresolvers import reverse, set_urlconf
+from django.http import HttpResponse
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models.loading import cache as app_cache
+from django.db.models.signals import post_init
 from django.template import Context, Template, TemplateDoesNotExist
 from django.template.loader import get_template
 from django.test import TestCase
+from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils import simplejson
 from django.utils.html import strip_tags
 from django.utils.http import int_to_base36
+from django.utils.timezone import now
 from django.contrib.sites.models import Site
+from follow import utils as follow_utils
 from PIL import Image
 
 from mezzanine.accounts import get_profile_model, get_profile_user_fieldname
-from mezzanine.blog.models import BlogPost
+from mezzanine.blog.management.commands import update_followers_count
+from mezzanine.blog.management.commands import update_ranking_score
+from mezzanine.blog.models import BlogCategory, BlogParentCategory
+from mezzanine.blog.models import BlogPost, category_tree
+from mezzanine.blog.templatetags.blog_tags import _blog_months
 from mezzanine.conf import settings, registry
+from mezzanine.conf.forms import SettingsForm
 from mezzanine.conf.models import Setting
-from mezzanine.core.models import CONTENT_STATUS_DRAFT
-from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
-from mezzanine.core.request import current_request
+from mezzanine.core.management.commands import benchmark_search
+from mezzanine.core.management.commands import rebuild_search_index
+from mezzanine.core.management.commands import warm_cache
+from mezzanine.core.middleware import UpdateCacheMiddleware, cache_record
+from mezzanine.core.middleware import nevercache_template
+from mezzanine.core.middleware import response_from_cache_record
+from mezzanine.core.models import CONTENT_STATUS_DRAFT, Displayable
+from mezzanine.core.models import CONTENT_STATUS_PUBLISHED, SearchTerm
+from mezzanine.core.models import SitePermission
+from mezzanine.core.request import CurrentRequestMiddleware, current_request
+from mezzanine.core.search import TrigramIndex, TypeaheadIndex
+from mezzanine.core.search import _typeahead_index, fuzzy_search, index_terms
+from mezzanine.core.views import search, search_key_terms
 from mezzanine.core.templatetags.mezzanine_tags import thumbnail
 from mezzanine.forms import fields
 from mezzanine.forms.models import Form
 from mezzanine.galleries.models import Gallery, GALLERIES_UPLOAD_DIR
 from mezzanine.generic.forms import RatingForm
 from mezzanine.generic.models import ThreadedComment, AssignedKeyword, Keyword
+from mezzanine.generic.models import RequiredReviewRating
 from mezzanine.pages.models import Page, RichTextPage
 from mezzanine.urls import PAGES_SLUG
+from mezzanine.utils.cache import _changes_key, _hashed_key, _snapshots
+from mezzanine.utils.cache import cache_get, cache_key_path
+from mezzanine.utils.cache import cache_key_prefix
+from mezzanine.utils.cache import cache_set, cache_tag_loaded, cache_tag_versions
+from mezzanine.utils.cache import cache_versions, nevercache_parts
+from mezzanine.utils.cache import nevercache_token, LRUCache
+from mezzanine.utils.device import device_from_request
+from mezzanine.utils.sites import current_site_id, user_site_ids
 from mezzanine.utils.importing import import_dotted_path
 from mezzanine.utils.tests import copy_test_to_media, run_pyflakes_for_package
+from mezzanine.utils.urls import RedirectTable
+from mezzanine.utils.views import CursorSerializer, approximate_count
+from mezzanine.utils.views import paginate, paginate_keyset
 from mezzanine.utils.tests import run_pep8_for_package
 from mezzanine.utils.models import get_user_model
+from mezzanine.core import managers
 from mezzanine.core.managers import DisplayableManager
 
 User = get_user_model()
 
 
+def uncompiled_device_from_request(request):
+    """
+    The device lookup before user agent strings were compiled,
+    looping through every user agent string for each lookup.
+    """
+    user_agent = request.META["HTTP_USER_AGENT"].lower()
+    for (device, ua_strings) in settings.DEVICE_USER_AGENTS:
+        for ua_string in ua_strings:
+            if ua_string.lower() in user_agent:
+                return device
+    return ""
+
+
+# The vendor listings for blog categories are routed by projects
+# rather than ``mezzanine.urls``, so tests that link to them use this
+# module as their URLconf.
+urlpatterns = patterns("",
+    url("^v/(?P<parent_category_slug>[-\w]+)/(?P<sub_category_slug>[-\w]+)/$",
+        "mezzanine.blog.views.get_vendors", name="get_vendors"),
+)
+
+
+@contextmanager
+def use_cache_middleware():
+    """
+    Installs Mezzanine's cache middleware for the duration of a test,
+    with an empty cache. ``cache_installed`` is otherwise ``False``
+    while testing.
+    """
+    update = "mezzanine.core.middleware.UpdateCacheMiddleware"
+    fetch = "mezzanine.core.middleware.FetchFromCacheMiddleware"
+    middleware = [m for m in settings.MIDDLEWARE_CLASSES
+                  if m not in (update, fetch)]
+    with override_settings(TESTING=False,
+                           MIDDLEWARE_CLASSES=[update] + middleware + [fetch]):
+        cache.clear()
+        post_init.connect(cache_tag_loaded)
+        try:
+            yield
+        finally:
+            post_init.disconnect(cache_tag_loaded)
+            cache.clear()
+
+
 class Tests(TestCase):
     """
     Mezzanine tests.
@@ -288,6 +382,443 @@ class Tests(TestCase):
         mobile = self.client.get(url, HTTP_USER_AGENT=ua)
         self.assertNotEqual(default.template_name[0], mobile.template_name[0])
 
+    def test_cache_key_path(self):
+        """
+        Test that URLs differing only in ignored, reordered or
+        differently cased querystring parameters share a cache key.
+        """
+        path = lambda qs: cache_key_path(RequestFactory().get("/x/?" + qs))
+        self.assertEqual(path("page=2&filter=Price"),
+                         path("filter=price&utm_source=a&page=2&t=123"))
+        self.assertEqual(path("fbclid=1&gclid=2"), "/x/")
+
+    def test_cache_stale_while_revalidate(self):
+        """
+        Test that stale cache entries are served while a single caller
+        holding the lease refreshes them in the background, and that
+        the lease is released when the refresh fails.
+        """
+        key = "test_cache_stale_while_revalidate"
+        lease_key = _hashed_key(key + ".lease")
+        started, finish, failed = Event(), Event(), Event()
+        refreshes = []
+
+        def refresh():
+            refreshes.append(key)
+            started.set()
+            finish.wait(5)
+            cache_set(key, "fresh")
+
+        def fail():
+            failed.set()
+            raise ValueError("Refresh failed")
+
+        def released():
+            for i in range(50):
+                if cache.get(lease_key) is None:
+                    return True
+                sleep(.1)
+            return False
+
+        cache_set(key, "stale", -1)
+        self.assertEqual(cache_get(key, refresh), None)
+        with override_settings(CACHE_STALE_WHILE_REVALIDATE=True):
+            cache_set(key, "stale", -1)
+            self.assertEqual(cache_get(key, refresh), "stale")
+            self.assertTrue(started.wait(5))
+            # The lease is held, so a second stale read doesn't refresh.
+            cache_set(key, "stale", -1)
+            self.assertEqual(cache_get(key, refresh), "stale")
+            finish.set()
+            self.assertTrue(released())
+            self.assertEqual(refreshes, [key])
+            self.assertEqual(cache_get(key, refresh), "fresh")
+            cache_set(key, "stale", -1)
+            self.assertEqual(cache_get(key, fail), "stale")
+            self.assertTrue(failed.wait(5))
+            self.assertTrue(released())
+
+    def test_cache_tags(self):
+        """
+        Test that cached pages are invalidated when a model instance
+        loaded while rendering them changes, but not when other
+        instances of the model are saved, and that pages aren't stored
+        if a model they loaded changed while they were rendered.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        with use_cache_middleware():
+            page = RichTextPage.objects.create(title="Tagged",
+                                               content="Before", **published)
+            other = RichTextPage.objects.create(title="Other", **published)
+            client = Client()
+            url = page.get_absolute_url()
+            self.assertContains(client.get(url), "Before")
+            RichTextPage.objects.filter(id=page.id).update(content="After")
+            self.assertContains(client.get(url), "Before")
+            RichTextPage.objects.get(id=page.id).save()
+            self.assertContains(client.get(url), "After")
+
+            def loaded_request():
+                request = RequestFactory().get("/")
+                request.session = {}
+                request._update_cache = True
+                CurrentRequestMiddleware().process_request(request)
+                RichTextPage.objects.get(id=page.id)
+                return request
+
+            versions = cache_tag_versions(loaded_request())
+            other.save()
+            self.assertEqual(cache_versions(versions.keys()), versions)
+            page.save()
+            self.assertNotEqual(cache_versions(versions.keys()), versions)
+            request = loaded_request()
+            other.save()
+            self.assertEqual(cache_tag_versions(request), None)
+
+    def test_nevercache_parts(self):
+        """
+        Test that content is split on the ``nevercache`` token, that
+        each fragment is only compiled once per process, and that the
+        least recently used fragments are discarded.
+        """
+        token = nevercache_token()
+        content = "a%s{{ 1 }}%sb" % (token, token)
+        self.assertEqual(nevercache_parts(content), ["a", "{{ 1 }}", "b"])
+        self.assertEqual(nevercache_parts("ab"), None)
+        template = nevercache_template("{{ nevercache }}")
+        self.assertTrue(nevercache_template("{{ nevercache }}") is template)
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertEqual((lru.get("a"), lru.get("b"), len(lru)), (1, None, 2))
+
+    def test_cache_response_record(self):
+        """
+        Test that cached responses replay their stored headers, are
+        sent gzipped to clients that accept it, and are sent as not
+        modified for a matching ``If-None-Match`` header, and that
+        responses already encoded by other middleware aren't stored.
+        """
+        response = HttpResponse("Cached", content_type="text/plain")
+        response["Content-Language"] = "fr"
+        response["X-Not-Cached"] = "1"
+        record = cache_record(response, {})
+        request = RequestFactory().get("/")
+        replayed = response_from_cache_record(request, record)
+        self.assertEqual(replayed.content, "Cached")
+        self.assertEqual(replayed["Content-Type"], "text/plain")
+        self.assertEqual(replayed["Content-Language"], "fr")
+        self.assertFalse(replayed.has_header("X-Not-Cached"))
+        request = RequestFactory().get("/", HTTP_ACCEPT_ENCODING="gzip")
+        gzipped = response_from_cache_record(request, record)
+        self.assertEqual(gzipped["Content-Encoding"], "gzip")
+        content = zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS)
+        self.assertEqual(content, "Cached")
+
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        with use_cache_middleware():
+            page = RichTextPage.objects.create(title="Cached", **published)
+            client = Client()
+            url = page.get_absolute_url()
+            client.get(url)
+            etag = client.get(url)["ETag"]
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, "")
+
+            request = RequestFactory().get("/encoded/")
+            request.session = {}
+            request.user = AnonymousUser()
+            request._update_cache = True
+            CurrentRequestMiddleware().process_request(request)
+            response = HttpResponse("Encoded")
+            response["Content-Encoding"] = "gzip"
+            UpdateCacheMiddleware().process_response(request, response)
+            key = cache_key_prefix(request) + cache_key_path(request)
+            self.assertEqual(cache_get(key), None)
+
+    def test_warm_cache(self):
+        """
+        Test that the ``warm_cache`` command requires the cache
+        middleware, and renders the published pages in the sitemap.
+        """
+        command = warm_cache.Command()
+        self.assertRaises(CommandError, command.handle, verbosity=0)
+        published = self._create_page("Warm", CONTENT_STATUS_PUBLISHED)
+        draft = self._create_page("Cold", CONTENT_STATUS_DRAFT)
+        urls = command.urls()
+        self.assertTrue(published.get_absolute_url() in urls)
+        self.assertFalse(draft.get_absolute_url() in urls)
+
+    def test_current_site_id(self):
+        """
+        Test that the site is found from the request's domain, also
+        after the domain is changed, and that the ``SITE_ID`` setting
+        is used for unknown domains without being stored against the
+        request.
+        """
+        site = Site.objects.create(domain="Site.example.com")
+
+        def request_for(host):
+            request = RequestFactory().get("/", HTTP_HOST=host)
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            return request
+
+        with override_settings(ALLOWED_HOSTS=["*"]):
+            with use_cache_middleware():
+                request_for("site.example.com")
+                self.assertEqual(current_site_id(), site.id)
+                site.domain = "moved.example.com"
+                site.save()
+                request_for("moved.example.com")
+                self.assertEqual(current_site_id(), site.id)
+                request = request_for("site.example.com")
+                self.assertEqual(current_site_id(), settings.SITE_ID)
+                self.assertEqual(getattr(request, "site_id", None), None)
+
+    def test_user_site_ids(self):
+        """
+        Test that the sites a staff user has permission for are cached
+        until the sites for their permission change from either side
+        of the relationship.
+        """
+        with use_cache_middleware():
+            user = User.objects.create(username="staff", is_staff=True)
+            perm = SitePermission.objects.get(user=user)
+            site_ids = set(perm.sites.values_list("id", flat=True))
+            self.assertEqual(user_site_ids(user), site_ids)
+            self.assertNumQueries(0, user_site_ids, user)
+            site = Site.objects.create(domain="staff.example.com")
+            perm.sites.add(site)
+            self.assertTrue(site.id in user_site_ids(user))
+            site.sitepermission_set.clear()
+            self.assertEqual(user_site_ids(user), site_ids)
+
+    def test_device_from_request(self):
+        """
+        Test that the compiled device lookup, repeated for a request
+        as it is for the cache key, template response and inclusion
+        tags, gives the same device as looping through every user
+        agent string.
+        """
+        user_agents = ["Mozilla/5.0 (X11; Linux x86_64) Firefox/20.0"]
+        for (device, ua_strings) in settings.DEVICE_USER_AGENTS:
+            user_agents.extend(["Mozilla/5.0 (%s)" % ua_string.upper()
+                                for ua_string in ua_strings])
+        for user_agent in user_agents:
+            request = RequestFactory().get("/", HTTP_USER_AGENT=user_agent)
+            expected = uncompiled_device_from_request(request)
+            for i in range(3):
+                self.assertEqual(device_from_request(request), expected)
+
+    def test_device_from_request_speed(self):
+        """
+        Micro-benchmark comparing the device lookups for a request,
+        done once each for the cache key, template response and a
+        handful of inclusion tags, against the previous approach of
+        looping through every user agent string for each lookup. The
+        timings are reported rather than compared, since they vary
+        too much between machines and runs to assert on.
+        """
+        user_agents = ("Mozilla/5.0 (X11; Linux x86_64) Firefox/20.0",
+                       "Mozilla/5.0 (iPhone; CPU iPhone OS 6_0) Safari")
+        lookups, requests = 10, 1000
+        timings = []
+        for lookup in (uncompiled_device_from_request, device_from_request):
+            start = time()
+            for i in range(requests):
+                for user_agent in user_agents:
+                    request = RequestFactory().get("/",
+                        HTTP_USER_AGENT=user_agent)
+                    for j in range(lookups):
+                        lookup(request)
+            timings.append((time() - start) / (requests * len(user_agents)))
+        before, after = [t * 1000000 for t in timings]
+        sys.stderr.write("\nDevice lookups per request: %.1fus before, "
+                         "%.1fus after\n" % (before, after))
+
+    def test_redirect_table(self):
+        """
+        Test that exact redirects take precedence over prefixes, and
+        that the longest matching prefix is used.
+        """
+        table = RedirectTable([("/a/*", "/x/"), ("/a/b/*", "/y/"),
+                               ("/a/b/c/", "/z/"), ("/gone/", "")])
+        self.assertEqual(table.get("/a/b/c/"), "/z/")
+        self.assertEqual(table.get("/a/b/d/"), "/y/")
+        self.assertEqual(table.get("/a/c/"), "/x/")
+        self.assertEqual(table.get("/gone/"), "")
+        self.assertEqual(table.get("/b/"), None)
+
+    def test_index_terms(self):
+        """
+        Test that words are stemmed and stop words removed when
+        building the search index.
+        """
+        self.assertEqual(index_terms("The caterers were running late"),
+                         ["caterer", "run", "late"])
+
+    def test_rebuild_search_index(self):
+        """
+        Test that rebuilding the search index indexes every row in
+        chunks, and removes the terms of rows deleted without signals
+        being sent.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        ids = [BlogPost.objects.create(title="Caterer", **published).id
+               for i in range(3)]
+        content_type = ContentType.objects.get_for_model(BlogPost)
+        SearchTerm.objects.create(term="florist", content_type=content_type,
+                                  object_pk=max(ids) + 1, weight=1)
+        command = rebuild_search_index.Command()
+        options = {"chunk_size": 2, "processes": 1, "verbosity": 0}
+        command.handle("blog.BlogPost", **options)
+        terms = SearchTerm.objects.filter(content_type=content_type)
+        self.assertEqual(sorted(terms.values_list("object_pk", flat=True)),
+                         ids)
+        self.assertEqual(set(terms.values_list("term", flat=True)),
+                         set(["caterer"]))
+        self.assertRaises(CommandError, command.handle, "core.SearchTerm",
+                          **options)
+
+    def test_benchmark_search(self):
+        """
+        Smoke test for the search benchmark against a small corpus,
+        checking that every query is timed for both the manager and
+        the view, and that the results are saved as JSON.
+        """
+        directory = mkdtemp()
+        output = os.path.join(directory, "benchmark.json")
+        try:
+            call_command("benchmark_search", posts=5, keywords=3,
+                         categories=2, runs=2, verbosity=0, output=output)
+            with open(output) as f:
+                data = simplejson.load(f)
+        finally:
+            rmtree(directory)
+        self.assertEqual(data["corpus"]["posts"], 5)
+        self.assertEqual(data["runs"], 2)
+        timed = [(r["name"], r["target"]) for r in data["results"]]
+        self.assertEqual(timed, [(name, target)
+                                 for (name, _, _) in benchmark_search.QUERIES
+                                 for target in ("manager", "view")])
+
+    def test_typeahead_index(self):
+        """
+        Test that suggestions match the start of any word in a title,
+        and can be replaced or removed by key.
+        """
+        titles = ["Green Valley Caterers", "Valley Florist", "Vale Hall"]
+        index = TypeaheadIndex(enumerate([{"title": t} for t in titles]))
+        found = [suggestion["title"] for suggestion in index.get("VAL")]
+        self.assertEqual(found, ["Vale Hall", "Green Valley Caterers",
+                                 "Valley Florist"])
+        self.assertEqual(len(index.get("valley", limit=1)), 1)
+        self.assertEqual(index.get("  "), [])
+        index.update(1, {"title": "Hilltop Florist"})
+        index.update(2)
+        found = [suggestion["title"] for suggestion in index.get("VAL")]
+        self.assertEqual(found, ["Green Valley Caterers"])
+        self.assertEqual(index.get("florist"), [{"title": "Hilltop Florist"}])
+        self.assertEqual(len(index), 2)
+
+    def test_trigram_index(self):
+        """
+        Test that misspelt titles are matched by similarity, and can
+        be replaced or removed by value.
+        """
+        titles = ["Stella Caterers", "Bella Flowers", "Stellar Photography"]
+        index = TrigramIndex([(title, title) for title in titles])
+        matches = index.get("stela catrers", 0.3)
+        self.assertEqual([title for (similarity, title) in matches],
+                         ["Stella Caterers"])
+        self.assertEqual(index.get("stela catrers", 1), [])
+        index.update("Stella Caterers")
+        index.update("Bella Flowers", "Stela Catering")
+        matches = index.get("stela catrers", 0.3)
+        self.assertEqual([title for (similarity, title) in matches],
+                         ["Bella Flowers"])
+        self.assertEqual(len(index), 2)
+
+    def test_typeahead_changes(self):
+        """
+        Test that the typeahead index kept in the process is updated
+        in place when a blog post's suggestion changes, is left as it
+        is when a save doesn't change it, and expires when a blog post
+        is due to be published.
+        """
+        def typeahead_index():
+            request = RequestFactory().get("/")
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            return _typeahead_index()
+
+        def suggested(prefix):
+            return [s["title"] for s in typeahead_index().get(prefix)]
+
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        with use_cache_middleware():
+            typeahead_index()
+            post = BlogPost.objects.create(title="Harbour Vendor", **published)
+            index = typeahead_index()
+            self.assertEqual(suggested("harb"), ["Harbour Vendor"])
+            name = "typeahead.%s" % post.site_id
+            changes = cache.get(_changes_key(name))
+            post.save()
+            self.assertEqual(cache.get(_changes_key(name)), changes)
+            post.title = "Harbour Florist"
+            post.save()
+            self.assertEqual(suggested("harb"), ["Harbour Florist"])
+            self.assertEqual(fuzzy_search("harbor florist", 0.3), [post.id])
+            post.status = CONTENT_STATUS_DRAFT
+            post.save()
+            self.assertEqual(suggested("harb"), [])
+            self.assertTrue(typeahead_index() is index)
+            publish_date = now() + timedelta(seconds=60)
+            BlogPost.objects.create(title="Harbour Hall",
+                                    publish_date=publish_date, **published)
+            self.assertEqual(suggested("harb"), [])
+            self.assertFalse(typeahead_index() is index)
+            self.assertTrue(_snapshots[name][2] <= time() + 61)
+
+    def test_typeahead_category_urls(self):
+        """
+        Test that a blog category's suggestion links to its vendor
+        listing once its parent category is added after it's created,
+        and follows its slug when it's renamed, rather than using the
+        category tree already stored on the request.
+        """
+        def suggested(prefix):
+            request = RequestFactory().get("/")
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            return [s["url"] for s in _typeahead_index().get(prefix)]
+
+        def vendors_url(category):
+            kwargs = {"parent_category_slug": "markets",
+                      "sub_category_slug": category.slug}
+            return reverse("get_vendors", kwargs=kwargs)
+
+        set_urlconf(__name__)
+        try:
+            with use_cache_middleware():
+                suggested("flea")
+                parent = BlogParentCategory.objects.create(title="Markets")
+                category = BlogCategory.objects.create(title="Flea Market")
+                category.parent_category.add(parent)
+                self.assertEqual(suggested("flea"), [vendors_url(category)])
+                category_tree()
+                category.slug = "fleas"
+                category.save()
+                self.assertEqual(suggested("flea"), [vendors_url(category)])
+                parent.blog_parent_category.clear()
+                self.assertEqual(suggested("flea"), [""])
+        finally:
+            set_urlconf(None)
+
     def test_blog_views(self):
         """
         Basic status code test for blog views.
@@ -313,6 +844,74 @@ class Tests(TestCase):
         redirect_path = urlparse(response.redirect_chain[0][0]).path
         self.assertEqual(redirect_path, settings.LOGIN_URL)
 
+    def test_category_tree(self):
+        """
+        Test that the category tree links categories and their parents
+        in title order, is kept in the process without querying the
+        database, and is loaded again once categories change.
+        """
+        def tree():
+            request = RequestFactory().get("/")
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            return category_tree()
+
+        with use_cache_middleware():
+            parent = BlogParentCategory.objects.create(title="Events")
+            categories = [BlogCategory.objects.create(title=title)
+                          for title in ("Music", "Catering")]
+            for category in categories:
+                category.parent_category.add(parent)
+            loaded = tree()
+            titles = lambda t: [c.title for c in t.categories_for(
+                                t.parents_by_slug[parent.slug])]
+            self.assertEqual(titles(loaded), ["Catering", "Music"])
+            self.assertEqual(loaded.categories_by_slug["music"].parent_ids,
+                             (parent.id,))
+            self.assertNumQueries(0, tree)
+            self.assertTrue(tree() is loaded)
+            categories[0].title = "Live Music"
+            categories[0].save()
+            self.assertEqual(titles(tree()), ["Catering", "Live Music"])
+            categories[1].parent_category.remove(parent)
+            self.assertEqual(titles(tree()), ["Live Music"])
+            self.assertEqual(tree().categories_by_slug["catering"].parent_ids,
+                             ())
+
+    def test_blog_months(self):
+        """
+        Test that the monthly archive counts the published blog posts
+        in each month, newest first, grouped by the database, and that
+        it's cached until a blog post is added.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        for (month, day) in ((1, 5), (1, 20), (3, 1)):
+            publish_date = now().replace(year=2012, month=month, day=day)
+            BlogPost.objects.create(title="Archived",
+                                    publish_date=publish_date, **published)
+        BlogPost.objects.create(title="Draft", user=self._user,
+                                status=CONTENT_STATUS_DRAFT,
+                                publish_date=now().replace(year=2012,
+                                                           month=2, day=1))
+        self.assertNumQueries(1, _blog_months)
+        self.assertEqual(_blog_months(), [
+            {"date": datetime(2012, 3, 1), "post_count": 1},
+            {"date": datetime(2012, 1, 1), "post_count": 2},
+        ])
+        template = ("{% load blog_tags %}{% blog_months as months %}"
+                    "{% for month in months %}{{ month.post_count }}"
+                    "{% endfor %}")
+        request = RequestFactory().get("/")
+        request.session = {}
+        CurrentRequestMiddleware().process_request(request)
+        with use_cache_middleware():
+            self.assertEqual(Template(template).render(Context()), "12")
+            self.assertEqual(self.queries_used_for_template(template), 0)
+            publish_date = now().replace(year=2012, month=3, day=2)
+            BlogPost.objects.create(title="Added", publish_date=publish_date,
+                                    **published)
+            self.assertEqual(Template(template).render(Context()), "22")
+
     def test_rating(self):
         """
         Test that ratings can be posted and avarage/count are calculated.
@@ -332,6 +931,64 @@ class Tests(TestCase):
         self.assertEqual(blog_post.rating_sum, _sum)
         self.assertEqual(blog_post.rating_average, average)
 
+    def test_followers_count(self):
+        """
+        Test that a blog post's followers count is kept current as it's
+        followed and unfollowed, and can be recalculated.
+        """
+        blog_post = BlogPost.objects.create(title="Followed", user=self._user,
+                                            status=CONTENT_STATUS_PUBLISHED)
+        followers = [User.objects.create_user("follower%s" % i,
+                                              "follower%s@example.com" % i,
+                                              "test") for i in range(2)]
+        count = lambda: BlogPost.objects.get(id=blog_post.id).followers_count
+        for follower in followers:
+            follow_utils.follow(follower, blog_post)
+        self.assertEqual(count(), 2)
+        follow_utils.unfollow(followers[0], blog_post)
+        self.assertEqual(count(), 1)
+        BlogPost.objects.filter(id=blog_post.id).update(followers_count=5)
+        update_followers_count.Command().handle(verbosity=0)
+        self.assertEqual(count(), 1)
+
+    def test_ranking_score(self):
+        """
+        Test that a blog post's ranking score is the sum of its review
+        rating averages, kept current as ratings are saved and deleted,
+        and can be recalculated.
+        """
+        blog_post = BlogPost.objects.create(title="Ranked", user=self._user,
+                                            status=CONTENT_STATUS_PUBLISHED)
+        content_type = ContentType.objects.get_for_model(BlogPost)
+        ratings = []
+        for (i, value) in enumerate((5, 3, 1)):
+            ratings.append(RequiredReviewRating.objects.create(
+                overall_value=value, price_value=value,
+                website_ex_value=value, quality_value=value,
+                service_value=value - 1 or 1, shop_again=1,
+                content_type=content_type, object_pk=blog_post.id,
+                commentid=i))
+        score = lambda: BlogPost.objects.get(id=blog_post.id).ranking_score
+        self.assertEqual(score(), 3 + 3 + 3 + (4 + 2 + 1) / 3.)
+        ratings[-1].delete()
+        self.assertEqual(score(), 4 + 4 + 4 + 3)
+        BlogPost.objects.filter(id=blog_post.id).update(ranking_score=0)
+        update_ranking_score.Command().handle(verbosity=0)
+        self.assertEqual(score(), 4 + 4 + 4 + 3)
+
+    def test_blog_post_listing_index(self):
+        """
+        Test that the index for the vendor listings is created along
+        with the blog post table.
+        """
+        if connection.vendor != "sqlite":
+            return
+        cursor = connection.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s",
+                       ["blog_blogpost_listing"])
+        self.assertTrue(cursor.fetchone()[0].endswith('("site_id", '
+            '"status", "overall_average", "ranking_score")'))
+
     def queries_used_for_template(self, template, **context):
         """
         Return the number of queries used when rendering a template
@@ -445,6 +1102,11 @@ class Tests(TestCase):
         finally:
             settings.PAGE_MENU_TEMPLATES = old_menu_temp
             settings.PAGE_MENU_TEMPLATES_DEFAULT = old_menu_temp_def
+            # The models have no tables, so remove them for tests that
+            # query every model, such as via the sitemap.
+            for name in ("p1", "p2", "p3"):
+                app_cache.app_models["core"].pop(name, None)
+            app_cache._get_models_cache.clear()
 
     def test_keywords(self):
         """
@@ -504,6 +1166,212 @@ class Tests(TestCase):
         if results:
             self.assertEqual(results[0].id, second)
 
+    def test_search_relevance(self):
+        """
+        Test that results are ordered by the weighted number of
+        occurrences of the search terms, counted in characters so
+        that terms with non-ASCII characters are scored correctly.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        create = lambda title, content: RichTextPage.objects.create(
+            title=title, content=content, **published).id
+        in_title = create(u"Caf\xe9", "")
+        in_content = create("Menu", u"caf\xe9 " * 3)
+        repeated = create("Menu", u"caf\xe9 " * 6)
+        fields = {"title": 5, "content": 1}
+        results = RichTextPage.objects.search(u"caf\xe9", search_fields=fields)
+        self.assertEqual([(r.id, r.result_count) for r in results],
+                         [(repeated, 6), (in_title, 5), (in_content, 3)])
+
+    def test_search_cached_ids(self):
+        """
+        Test that the ordered IDs of search results are cached, and
+        expired once the searched model changes.
+        """
+        def result_ids(query):
+            request = RequestFactory().get("/search/", {"q": query})
+            request.session = {}
+            request.user = AnonymousUser()
+            CurrentRequestMiddleware().process_request(request)
+            results = search(request).context_data["results"]
+            return [result.id for result in results.object_list]
+
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        with use_cache_middleware():
+            cached = BlogPost.objects.create(title="Cached", **published)
+            other = BlogPost.objects.create(title="Other", **published)
+            self.assertEqual(result_ids("cached"), [cached.id])
+            BlogPost.objects.filter(id=other.id).update(title="Cached too")
+            self.assertEqual(result_ids("cached"), [cached.id])
+            self.assertEqual(result_ids("Cached"), [cached.id])
+            BlogPost.objects.get(id=other.id).save()
+            self.assertEqual(sorted(result_ids("cached")),
+                             sorted([cached.id, other.id]))
+
+    def test_search_key_terms(self):
+        """
+        Test that the terms for caching search results ignore case,
+        repeated terms and their order, but keep modifiers and phrases.
+        """
+        self.assertEqual(search_key_terms("Stella bar stella"),
+                         search_key_terms("bar stella"))
+        self.assertNotEqual(search_key_terms("stella -bar"),
+                            search_key_terms("stella +bar"))
+        self.assertNotEqual(search_key_terms('"stella bar"'),
+                            search_key_terms("stella bar"))
+        self.assertEqual(search_key_terms('-"Stella Bar"'),
+                         '-"stella bar"')
+
+    def test_federated_search(self):
+        """
+        Test that searching across models merges the results from each
+        model by relevance, with the time taken for each model.
+        """
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        RichTextPage.objects.create(title="federated", **published)
+        Form.objects.create(title="federated federated", **published)
+        results = Displayable.objects.search("federated")
+        self.assertEqual([r.__class__ for r in results], [Form, RichTextPage])
+        self.assertTrue(RichTextPage in results.timings)
+
+    def test_federated_search_threads(self):
+        """
+        Test that searching across models on the pool of threads gives
+        the same results as searching in the current thread. The pool's
+        threads share the test's database connection, as the server's
+        thread does in ``LiveServerTestCase``, so that they can read
+        the test's data.
+        """
+        def share_connection(connection):
+            connections[DEFAULT_DB_ALIAS] = connection
+
+        published = {"status": CONTENT_STATUS_PUBLISHED}
+        RichTextPage.objects.create(title="federated", **published)
+        Form.objects.create(title="federated federated", **published)
+        RichTextPage.objects.create(title="pooled federated", **published)
+        serial = Displayable.objects.search("federated")
+        shared = connections[DEFAULT_DB_ALIAS]
+        shared.allow_thread_sharing = True
+        pool = ThreadPool(2, share_connection, (shared,))
+        managers._search_pool_instance = pool
+        try:
+            with override_settings(TESTING=False, SEARCH_FEDERATED_THREADS=2):
+                pooled = Displayable.objects.search("federated")
+        finally:
+            managers._search_pool_instance = None
+            pool.close()
+            pool.join()
+            shared.allow_thread_sharing = False
+        self.assertEqual(len(serial), 3)
+        self.assertEqual(pooled, serial)
+        self.assertEqual(set(pooled.timings), set(serial.timings))
+
+    def test_paginate_keyset(self):
+        """
+        Test that following the cursors from ``paginate_keyset`` visits
+        every object once in order, with ties broken by primary key.
+        """
+        for title in ("b", "a", "c", "a", "d"):
+            RichTextPage.objects.create(title=title)
+        pages = RichTextPage.objects.all()
+        expected = list(pages.order_by("title", "pk"))
+        found = []
+        cursors = [""]
+        while cursors[-1] is not None:
+            page = paginate_keyset(pages, cursors[-1], 2, ("title",))
+            found.extend(page.object_list)
+            cursors.append(page.next_cursor)
+        self.assertEqual(found, expected)
+        self.assertEqual(page.paginator.num_pages, 3)
+        previous = paginate_keyset(pages, page.previous_page_number(), 2,
+                                   ("title",))
+        self.assertEqual(previous.object_list, expected[2:4])
+        expected = sorted(pages, key=lambda p: (p.publish_date, p.pk),
+                          reverse=True)
+        found = []
+        cursor = ""
+        while cursor is not None:
+            page = paginate_keyset(pages, cursor, 2, ("-publish_date",))
+            found.extend(page.object_list)
+            cursor = page.next_cursor
+        self.assertEqual(found, expected)
+        # A cursor from a listing with a different ordering gives the
+        # first page.
+        cursor = paginate_keyset(pages, "", 2, ("title",)).next_cursor
+        for ordering in (("-publish_date",), ("title", "-publish_date")):
+            page = paginate_keyset(pages, cursor, 2, ordering)
+            first = paginate_keyset(pages, "", 2, ordering)
+            self.assertEqual(page.number, 1)
+            self.assertEqual(page.object_list, first.object_list)
+        self.assertEqual(paginate_keyset(pages, "", 2, count=False).paginator,
+                         None)
+        with use_cache_middleware():
+            self.assertEqual(approximate_count(pages.filter(pk__in=[])), 0)
+            self.assertEqual(approximate_count(pages), len(expected))
+
+    def test_paginate_count(self):
+        """
+        Test that the count of paginated objects is cached until an
+        object is added, or the next object is due to be published.
+        """
+        def count():
+            request = RequestFactory().get("/")
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            blog_posts = BlogPost.objects.published()
+            return paginate(blog_posts, 1, 10, 10, "test").paginator.count
+
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        with use_cache_middleware():
+            blog_post = BlogPost.objects.create(title="Counted", **published)
+            self.assertEqual(count(), 1)
+            blog_posts = BlogPost.objects.filter(id=blog_post.id)
+            blog_posts.update(status=CONTENT_STATUS_DRAFT)
+            self.assertEqual(count(), 1)
+            blog_posts.update(status=CONTENT_STATUS_PUBLISHED)
+            BlogPost.objects.create(title="Added", **published)
+            self.assertEqual(count(), 2)
+            publish_date = now() + timedelta(seconds=1)
+            BlogPost.objects.create(title="Scheduled",
+                                    publish_date=publish_date, **published)
+            self.assertEqual(count(), 2)
+            sleep(2.5)
+            self.assertEqual(count(), 3)
+
+    def test_paginate_count_category_deleted(self):
+        """
+        Test that the cached count for a category's listing is expired
+        when the category is deleted, which removes its blog posts'
+        assignments without ``m2m_changed`` being sent.
+        """
+        def count():
+            request = RequestFactory().get("/")
+            request.session = {}
+            CurrentRequestMiddleware().process_request(request)
+            blog_posts = BlogPost.objects.published().filter(
+                categories__isnull=False)
+            return paginate(blog_posts, 1, 10, 10, "test").paginator.count
+
+        published = {"status": CONTENT_STATUS_PUBLISHED, "user": self._user}
+        with use_cache_middleware():
+            count()
+            category = BlogCategory.objects.create(title="Bakeries")
+            blog_post = BlogPost.objects.create(title="Counted", **published)
+            blog_post.categories.add(category)
+            self.assertEqual(count(), 1)
+            category.delete()
+            self.assertEqual(count(), 0)
+
+    def test_cursor_serializer(self):
+        """
+        Test that the sort values in keyset pagination cursors are
+        loaded as the same types they were stored as.
+        """
+        serializer = CursorSerializer()
+        values = [now(), now().date(), Decimal("1.50"), u"caf\xe9", 2, None]
+        self.assertEqual(serializer.loads(serializer.dumps(values)), values)
+        self.assertRaises(TypeError, serializer.dumps, [object()])
+
     def test_forms(self):
         """
         Simple 200 status check against rendering and posting to forms
@@ -554,6 +1422,71 @@ class Tests(TestCase):
         for (name, value) in values_by_name.items():
             self.assertEqual(getattr(settings, name), value)
 
+    def test_settings_per_site(self):
+        """
+        Test that editable settings are loaded for the current site,
+        and only loaded from the DB again for a site once the settings
+        form is saved for it.
+        """
+        name = [s["name"] for s in registry.values()
+                if s["editable"] and s["type"] is int][0]
+        sites = [Site.objects.create(domain="site%s.com" % i)
+                 for i in (1, 2)]
+
+        def use_site(site):
+            request = RequestFactory().get("/")
+            request.session = {"site_id": site.id}
+            CurrentRequestMiddleware().process_request(request)
+            settings.use_editable()
+
+        with use_cache_middleware():
+            for (i, site) in enumerate(sites):
+                use_site(site)
+                Setting.objects.create(name=name, value=str(i))
+            for (i, site) in enumerate(sites):
+                use_site(site)
+                self.assertEqual(getattr(settings, name), i)
+                self.assertNumQueries(0, getattr, settings, name)
+            Setting._base_manager.filter(name=name).update(value="10")
+            form = SettingsForm()
+            data = dict([(field.name, field.value()) for field in form
+                         if field.value() is not None])
+            data[name] = 20
+            form = SettingsForm(data)
+            self.assertTrue(form.is_valid())
+            form.save()
+            use_site(sites[1])
+            self.assertEqual(getattr(settings, name), 20)
+            use_site(sites[0])
+            self.assertEqual(getattr(settings, name), 0)
+
+    def test_settings_float(self):
+        """
+        Test that float settings are validated by the settings form,
+        and that an invalid value stored in the DB falls back to the
+        setting's default.
+        """
+        request = RequestFactory().get("/")
+        request.session = {}
+        CurrentRequestMiddleware().process_request(request)
+        name = "SEARCH_FUZZY_THRESHOLD"
+        form = SettingsForm()
+        data = dict([(field.name, field.value()) for field in form
+                     if field.value() is not None])
+        for value in ("", "similar"):
+            data[name] = value
+            self.assertFalse(SettingsForm(data).is_valid())
+        data[name] = "0.5"
+        form = SettingsForm(data)
+        self.assertTrue(form.is_valid())
+        form.save()
+        settings.use_editable()
+        self.assertEqual(settings.SEARCH_FUZZY_THRESHOLD, 0.5)
+        Setting.objects.filter(name=name).update(value="")
+        settings.use_editable()
+        self.assertEqual(settings.SEARCH_FUZZY_THRESHOLD,
+                         registry[name]["default"])
+
     def test_syntax(self):
         """
         Run pyflakes/pep8 across the code base to check for potential errors.
@@ -18,6 +18,7 @@ if "django.contrib.admin" in settings.INSTALLED_APPS:
 urlpatterns += patterns("mezzanine.core.views",
     url("^edit/$", "edit", name="edit"),
     url("^search/$", "search", name="search"),
+    url("^search/typeahead/$", "search_typeahead", name="search_typeahead"),
     url("^set_site/$", "set_site", name="set_site"),
     url("^set_device/(?P<device>.*)/$", "set_device", name="set_device"),
     url("^asset_proxy/$", "static_proxy", name="static_proxy"),
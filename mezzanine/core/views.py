@@ -13,20 +13,25 @@ from django.http import (HttpResponse, HttpResponseServerError,
 from django.shortcuts import redirect
 from django.template import RequestContext
 from django.template.loader import get_template
+from django.utils import simplejson
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import requires_csrf_token
 
 from mezzanine.conf import settings
 from mezzanine.core.forms import get_edit_form
-from mezzanine.core.models import Displayable, SitePermission
-from mezzanine.utils.cache import add_cache_bypass
+from mezzanine.core.managers import parse_search_query
+from mezzanine.core.models import Displayable
+from mezzanine.core.search import fuzzy_search, typeahead
+from mezzanine.utils.cache import add_cache_bypass, cache_installed
+from mezzanine.utils.cache import cache_tag_label, cache_tagged
+from mezzanine.utils.cache import publish_cache_timeout
 from mezzanine.utils.views import is_editable, paginate, render, set_cookie
-from mezzanine.utils.sites import has_site_permission
+from mezzanine.utils.sites import current_site_id, has_site_permission
+from mezzanine.utils.sites import user_site_ids
 from mezzanine.blog.views import is_valid_search_filter
 from mezzanine.blog.models import BlogPost
 from mezzanine.core.models import CONTENT_STATUS_PUBLISHED
 
-from follow.models import Follow
 
 def set_device(request, device=""):
     """
@@ -48,9 +53,7 @@ def set_site(request):
     """
     site_id = int(request.GET["site_id"])
     if not request.user.is_superuser:
-        try:
-            SitePermission.objects.get(user=request.user, sites=site_id)
-        except SitePermission.DoesNotExist:
+        if site_id not in user_site_ids(request.user):
             raise PermissionDenied
     request.session["site_id"] = site_id
     admin_url = reverse("admin:index")
@@ -106,6 +109,24 @@ def searchComparator(object1, object2):
     else:
         return 1
 
+def search_key_terms(query):
+    """
+    Returns the terms in a search query for caching its results.
+    Terms are matched regardless of case, so they're lowercased,
+    deduplicated and sorted. Phrases are quoted to keep them apart
+    from the same words given separately, and any + or - modifier is
+    kept in front of each term.
+    """
+    terms = set()
+    for term in parse_search_query(query)[0]:
+        modifier = term[0:1] if term[0:1] in "+-" else ""
+        term = term[len(modifier):].lower()
+        if len(term.split()) > 1:
+            term = '"%s"' % term
+        terms.add(modifier + term)
+    return " ".join(sorted(terms))
+
+
 def search(request, template="search_results.html"):
     """
     Display search results. Takes an optional "contenttype" GET parameter
@@ -116,7 +137,6 @@ def search(request, template="search_results.html"):
     page = request.GET.get("page", 1)
     per_page = settings.SEARCH_PER_PAGE
     max_paging_links = settings.MAX_PAGING_LINKS
-    table_name = BlogPost._meta.db_table
     try:
         search_model = get_model(*request.GET.get("type", "").split(".", 1))
         if not issubclass(search_model, Displayable):
@@ -128,6 +148,13 @@ def search(request, template="search_results.html"):
         search_type = search_model._meta.verbose_name_plural.capitalize()
     queryWithQuotes = '"%s"' % query
     results = search_model.objects.search(queryWithQuotes, for_user=request.user)
+    if search_model._meta.abstract:
+        # Searches across several models are ranked by relevance
+        # rather than by vendor ratings.
+        paginated = paginate(results, page, per_page, max_paging_links)
+        context = {"query": query, "results": paginated,
+                   "search_type": search_type}
+        return render(request, template, context)
 
     '''
         Check for search query to match to a store. If it is include the store even though that store is not yet published.
@@ -155,27 +182,76 @@ def search(request, template="search_results.html"):
         In case filter values are equal, order them as per their overall average.
         For now tie between equal overall_average is not broken. To break add more parameters ahead in order of priority.
         '''
-        results = results.extra(select={'filtersum': filter_sum,
-                                                     'fieldsum':'price_average + website_ex_average + quality_average + service_average',
-                                                     'followers': 'SELECT COUNT(*) FROM %s WHERE target_blogpost_id=%s.id' % (Follow._meta.db_table, table_name)},
-                                                     order_by=('-filtersum', '-overall_average', '-fieldsum', '-comments_count', '-followers',)).distinct()
+        results = results.extra(select={'filtersum': filter_sum},
+                                                     order_by=('-filtersum', '-overall_average', '-ranking_score', '-comments_count', '-followers_count', '-result_count',)).distinct()
     else:
         '''
             In absence of any filters, order vendors by overall_average by default.
         '''
-        results = results.extra(select={'fieldsum':'price_average + website_ex_average + quality_average + service_average',
-                                        'followers': 'SELECT COUNT(*) FROM %s WHERE target_blogpost_id=%s.id' % (Follow._meta.db_table, table_name)},
-                                        order_by=('-overall_average', '-fieldsum', '-comments_count', '-followers',)).distinct()
+        results = results.extra(order_by=('-overall_average', '-ranking_score', '-comments_count', '-followers_count', '-result_count',)).distinct()
 
     #results.sort(searchComparator, reverse=True)
 
-    paginated = paginate(results, page, per_page, max_paging_links)
+    if cache_installed():
+        # Cache the ordered IDs for the results, keyed by the parsed
+        # query, and only load the results for the page displayed.
+        # The query itself is also part of the key, as vendors whose
+        # names match it exactly are included.
+        key = "%s.search.%s.%s.%s.%s.%s.%s" % (
+            settings.CACHE_MIDDLEWARE_KEY_PREFIX, current_site_id(),
+            search_model._meta, request.user.is_staff, filters.lower(),
+            search_key_terms(queryWithQuotes), query.lower())
+        tags = ["%s.*" % cache_tag_label(search_model)]
+        names = ["id"] + results.query.extra.keys()
+        load = lambda: [row[0] for row in results.values_list(*names)]
+        timeout = lambda: publish_cache_timeout(search_model)
+        ids = cache_tagged(key, tags, load, timeout)
+    else:
+        ids = None
+        paginated = paginate(results, page, per_page, max_paging_links)
+        if not paginated.paginator.count:
+            ids = []
+
+    if ids == [] and search_model is BlogPost:
+        # Nothing matched the query, so fall back to vendors whose
+        # names or keywords are similar to it, to allow for
+        # misspellings.
+        results = BlogPost.objects.published(for_user=request.user)
+        ids = fuzzy_search(query)
+        if ids:
+            published = results.filter(id__in=ids)
+            published = set(published.values_list("id", flat=True))
+            ids = [i for i in ids if i in published]
+
+    if ids is not None:
+        paginated = paginate(ids, page, per_page, max_paging_links)
+        loaded = results.filter(id__in=paginated.object_list)
+        loaded = dict([(result.id, result) for result in loaded])
+        paginated.object_list = [loaded[i] for i in paginated.object_list
+                                 if i in loaded]
 
     context = {"query": query, "results": paginated,
                "search_type": search_type}
     return render(request, template, context)
 
 
+def search_typeahead(request):
+    """
+    Returns the titles of blog posts, blog categories and keywords that
+    start with the ``q`` querystring param as JSON, for suggestions
+    while a search query is typed. Suggestions are looked up in an
+    index held in the process, so no queries are made once the index
+    is loaded.
+    """
+    try:
+        limit = int(request.GET.get("limit", 10))
+    except ValueError:
+        limit = 10
+    suggestions = typeahead(request.GET.get("q", ""), min(limit, 50))
+    return HttpResponse(simplejson.dumps(suggestions),
+                        mimetype="application/json")
+
+
 @staff_member_required
 def static_proxy(request):
     """
@@ -282,6 +282,7 @@ class RequiredReviewRatingField(BaseGenericRelation):
               "overall_averageR": IntegerField(default=0, editable=False),
               "overall_poorR": IntegerField(default=0, editable=False),
               "overall_terribleR": IntegerField(default=0, editable=False),
+              "ranking_score": FloatField(default=0, editable=False),
               }
 
     def related_items_changed(self, instance, related_manager):
@@ -349,6 +350,11 @@ class RequiredReviewRatingField(BaseGenericRelation):
         setattr(instance, "overall_averageR", overall_averageR)
         setattr(instance, "overall_poorR", overall_poorR)
         setattr(instance, "overall_terribleR", overall_terribleR)
+        # Stored so that listings can be sorted on the column, rather
+        # than on the sum of the averages calculated for every row.
+        ranking_score = (price_average + website_ex_average +
+                         quality_average + service_average)
+        setattr(instance, "ranking_score", ranking_score)
         instance.save()
 
 class OptionalReviewRatingField(BaseGenericRelation):
@@ -20,7 +20,7 @@ from mezzanine.conf import settings
 from mezzanine.generic.forms import ThreadedCommentForm, RatingForm, ReviewForm
 from mezzanine.generic.models import Keyword, Review, RequiredReviewRating, OptionalReviewRating
 from mezzanine.utils.cache import add_cache_bypass
-from mezzanine.utils.views import render, set_cookie, is_spam
+from mezzanine.utils.views import render, set_cookie, is_spam, paginate_keyset
 from mezzanine.blog.models import BlogPost, BlogCategory
 
 from actstream import action
@@ -358,7 +358,16 @@ def fetch_range_commenters_on_obj(request, content_type_id, object_id, sIndex=0,
     s = (int)(""+sIndex)
     l = (int)(""+lIndex)
 
-    sub_commenters = commenters[s:l]
+    next_cursor = None
+    if "cursor" in request.GET:
+        # Seek past the last commenter already shown rather than
+        # using an offset.
+        page = paginate_keyset(commenters, request.GET["cursor"],
+                               max(l - s, 1), ordering=("pk",), count=False)
+        sub_commenters = page.object_list
+        next_cursor = page.next_cursor
+    else:
+        sub_commenters = commenters[s:l]
 
     if s == 0:
         data_href = reverse('fetch_range_commenters_on_obj', kwargs={ 'content_type_id':content_type_id,
@@ -380,7 +389,8 @@ def fetch_range_commenters_on_obj(request, content_type_id, object_id, sIndex=0,
         if sub_commenters:
             ret_data = {
                 'html': render_to_string(template, context_instance=context).strip(),
-                'success': True
+                'success': True,
+                'cursor': next_cursor
             }
         else:
             ret_data = {
@@ -419,17 +429,32 @@ def fetch_range_comments_on_obj(request, content_type_id, object_id, sIndex, lIn
     s = (int)(""+sIndex)
     l = (int)(""+lIndex)
     
-    comments_queryset =  comments_queryset.order_by('-submit_date')[s:l]
+    next_cursor = None
+    if "cursor" in request.GET:
+        # Seek past the last comment already shown rather than using
+        # an offset.
+        page = paginate_keyset(comments_queryset, request.GET["cursor"],
+                               max(l - s, 1), ordering=("-submit_date",),
+                               count=False)
+        comments_queryset = page.object_list
+        next_cursor = page.next_cursor
+    else:
+        comments_queryset =  comments_queryset.order_by('-submit_date')[s:l]
 
     small = request.GET.get("small", None)
     if small:
-        return render_to_response('generic/includes/subcomment_small.html', {
+        response = render_to_response('generic/includes/subcomment_small.html', {
            'comments_for_thread': comments_queryset, 
         }, context_instance=RequestContext(request))
     else:
-        return render_to_response('generic/includes/subcomment.html', {
+        response = render_to_response('generic/includes/subcomment.html', {
             'comments_for_thread': list(comments_queryset)[::-1], 
         }, context_instance=RequestContext(request))
+    # Given as a header so that the script loading the next range of
+    # comments can follow it, without the templates rendering it.
+    if next_cursor is not None:
+        response["X-Next-Cursor"] = next_cursor
+    return response
 
 def rating(request):
     """
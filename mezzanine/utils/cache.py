@@ -1,15 +1,66 @@
 
+from collections import OrderedDict
+from cStringIO import StringIO
+from fnmatch import translate
 from hashlib import md5
+from logging import getLogger
+import re
+from threading import Lock
 from time import time
+from urllib import urlencode
+from urlparse import parse_qsl
+from uuid import uuid4
 
 from django.core.cache import cache
+from django.db.models.signals import post_delete
 from django.utils.cache import _i18n_cache_key_suffix
 
 from mezzanine.conf import settings
+from mezzanine.core.request import current_request
 from mezzanine.utils.device import device_from_request
 from mezzanine.utils.sites import current_site_id
 
 
+# WSGI environ key used to mark a request that should bypass the
+# cache lookup and regenerate its cache entry. Not prefixed with
+# ``HTTP_`` so that it can't be supplied by a client as a header.
+CACHE_REFRESH_ENVIRON_KEY = "mezzanine.cache_refresh"
+
+# Querystring parameter added by ``add_cache_bypass``.
+CACHE_BYPASS_PARAM = "t"
+
+# Number of increments to a process' cache statistics before they're
+# added to the totals stored in the cache backend.
+STATS_FLUSH_COUNT = 100
+
+logger = getLogger(__name__)
+
+_refresh_pool = None
+_refresh_pool_lock = Lock()
+_refresh_handler = None
+
+# Version keys are stored for the longest timeout memcached accepts
+# as a relative value (30 days), since there's no portable way of
+# storing a key without expiry across Django's cache backends.
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# Pages that load more than this many instances of tagged models are
+# tagged per model rather than per instance.
+MAX_INSTANCE_TAGS = 100
+_tag_models_cache = None
+_ignored_params = (None, None)
+_stats = {}
+_stats_lock = Lock()
+_snapshots = {}
+_snapshots_lock = Lock()
+
+# Changes recorded by ``cache_snapshot_change`` are kept for a day.
+# A process with more than ``MAX_SNAPSHOT_CHANGES`` changes to apply
+# to a snapshot, or whose changes have expired, loads it again.
+SNAPSHOT_CHANGE_TIMEOUT = 60 * 60 * 24
+MAX_SNAPSHOT_CHANGES = 100
+
+
 def _hashed_key(key):
     """
     Hash keys when talking directly to the cache API, to avoid
@@ -37,23 +88,322 @@ def cache_set(key, value, timeout=None, refreshed=False):
     return cache.set(_hashed_key(key), packed, real_timeout)
 
 
-def cache_get(key):
+def cache_get(key, refresh=None):
     """
     Wrapper for ``cache.get``. The expiry time for the cache entry
     is stored with the entry. If the expiry time has past, put the
     stale entry back into cache, and don't return it to trigger a
     fake cache miss.
+
+    If the ``CACHE_STALE_WHILE_REVALIDATE`` setting is ``True`` and a
+    ``refresh`` callable is given, the stale entry is returned to
+    every caller instead. The first caller to acquire the refresh
+    lease for the key then runs ``refresh`` on a background thread,
+    which is expected to store a new entry for the key.
     """
     packed = cache.get(_hashed_key(key))
     if packed is None:
         return None
     value, refresh_time, refreshed = packed
     if (time() > refresh_time) and not refreshed:
-        cache_set(key, value, settings.CACHE_SET_DELAY_SECONDS, True)
-        return None
+        if refresh is None or not settings.CACHE_STALE_WHILE_REVALIDATE:
+            cache_set(key, value, settings.CACHE_SET_DELAY_SECONDS, True)
+            return None
+        lease_key = _hashed_key(key + ".lease")
+        # ``cache.add`` is atomic in the cache backend, so only one
+        # process will acquire the lease and perform the refresh.
+        if cache.add(lease_key, True, settings.CACHE_SET_DELAY_SECONDS):
+            cache_set(key, value, settings.CACHE_SET_DELAY_SECONDS, True)
+            _refresh_in_background(refresh, lease_key)
     return value
 
 
+def _refresh_in_background(refresh, lease_key):
+    """
+    Runs the ``refresh`` callable on the background thread pool,
+    sized by the ``CACHE_REFRESH_THREADS`` setting, releasing the
+    refresh lease once it's done. The pool discards exceptions raised
+    by the callable, so they're logged here instead.
+    """
+    global _refresh_pool
+    with _refresh_pool_lock:
+        if _refresh_pool is None:
+            from multiprocessing.pool import ThreadPool
+            _refresh_pool = ThreadPool(settings.CACHE_REFRESH_THREADS)
+
+    def run():
+        try:
+            refresh()
+        except Exception:
+            logger.exception("Error refreshing stale cache entry")
+        finally:
+            cache.delete(lease_key)
+
+    _refresh_pool.apply_async(run)
+
+
+def cache_refresh(environ):
+    """
+    Runs the request described by the given WSGI environ through
+    Django's request handler, marked with ``CACHE_REFRESH_ENVIRON_KEY``
+    so that ``FetchFromCacheMiddleware`` skips the cache lookup and
+    ``UpdateCacheMiddleware`` stores the freshly rendered response.
+    Returns the response's status line.
+    """
+    global _refresh_handler
+    from django.core.handlers.wsgi import WSGIHandler
+    if _refresh_handler is None:
+        _refresh_handler = WSGIHandler()
+    environ = dict(environ)
+    environ[CACHE_REFRESH_ENVIRON_KEY] = True
+    environ["wsgi.input"] = StringIO("")
+    status = []
+    start_response = lambda s, headers, exc_info=None: status.append(s)
+    response = _refresh_handler(environ, start_response)
+    try:
+        for chunk in response:
+            pass
+    finally:
+        # Closing the response sends ``request_finished``, which
+        # closes the database connection used by this thread.
+        if hasattr(response, "close"):
+            response.close()
+    return status[0] if status else ""
+
+
+def _version_key(name):
+    return _hashed_key("%s.version.%s" %
+                       (settings.CACHE_MIDDLEWARE_KEY_PREFIX, name))
+
+
+def cache_versions(names):
+    """
+    Returns a dict mapping each of the given names to the version
+    token stored for it in the cache backend. Missing versions are
+    created, so that a version that has been evicted from the cache
+    never matches a version that was previously read.
+    """
+    keys = dict([(_version_key(name), name) for name in names])
+    versions = cache.get_many(keys.keys())
+    for key in set(keys) - set(versions):
+        cache.add(key, uuid4().hex, VERSION_TIMEOUT)
+        versions[key] = cache.get(key)
+    return dict([(keys[key], version) for key, version in versions.items()])
+
+
+def cache_version(name):
+    """
+    Returns the version token stored in the cache backend for a
+    single name - see ``cache_versions``.
+    """
+    return cache_versions([name])[name]
+
+
+def bump_cache_version(*names):
+    """
+    Stores new version tokens for each of the given names, which
+    invalidates anything stored against their previous versions.
+    """
+    versions = dict([(_version_key(name), uuid4().hex) for name in names])
+    cache.set_many(versions, VERSION_TIMEOUT)
+
+
+def cache_versioned(name, load, timeout=None):
+    """
+    Returns the value created by calling ``load``, which is stored in
+    the cache backend until ``bump_cache_version`` is called with the
+    given name. The value and its version are retrieved together, so
+    a hit costs a single round trip to the cache backend.
+    """
+    version_key = _version_key(name)
+    value_key = _hashed_key("%s.versioned.%s" %
+                            (settings.CACHE_MIDDLEWARE_KEY_PREFIX, name))
+    found = cache.get_many([version_key, value_key])
+    version = found.get(version_key)
+    if version is None:
+        version = cache_version(name)
+    elif value_key in found and found[value_key][0] == version:
+        return found[value_key][1]
+    value = load()
+    cache.set(value_key, (version, value), timeout)
+    return value
+
+
+def cache_tagged(key, tags, load, timeout=None):
+    """
+    Returns the value created by calling ``load``, which is stored in
+    the cache backend under the given key until any of the given tags
+    are invalidated by ``bump_cache_version``, or the timeout passes.
+    The timeout can be a callable, which is only called when the value
+    is loaded. The value and the tag versions are retrieved together,
+    so a hit costs a single round trip to the cache backend.
+    """
+    value_key = _hashed_key(key)
+    version_keys = dict([(_version_key(tag), tag) for tag in tags])
+    found = cache.get_many(version_keys.keys() + [value_key])
+    stored = found.pop(value_key, None)
+    versions = dict([(version_keys[k], v) for (k, v) in found.items()])
+    if len(versions) < len(version_keys):
+        versions = cache_versions(tags)
+    elif stored is not None and stored[0] == versions:
+        return stored[1]
+    value = load()
+    if callable(timeout):
+        timeout = timeout()
+    cache.set(value_key, (versions, value), timeout)
+    return value
+
+
+def publish_cache_timeout(model):
+    """
+    Returns the number of seconds that values listing the model's
+    published instances can be cached for, which is until the next
+    publish or expiry date of any of its instances, so that they
+    don't go stale when an instance is published or expires without
+    being saved. Models without these dates are cached for
+    ``CACHE_MIDDLEWARE_SECONDS``.
+    """
+    from django.db.models import Min
+    from django.utils.timezone import now
+    timeout = settings.CACHE_MIDDLEWARE_SECONDS
+    current = now()
+    names = [field.name for field in model._meta.fields]
+    for name in ("publish_date", "expiry_date"):
+        if name not in names:
+            continue
+        lookup = {"%s__gt" % name: current}
+        upcoming = model.objects.filter(**lookup).aggregate(Min(name))
+        upcoming = upcoming["%s__min" % name]
+        if upcoming is not None:
+            seconds = int((upcoming - current).total_seconds()) + 1
+            timeout = min(timeout, seconds)
+    return timeout
+
+
+def _changes_key(name, number=None):
+    key = "%s.changes.%s" % (settings.CACHE_MIDDLEWARE_KEY_PREFIX, name)
+    if number is not None:
+        key = "%s.%s" % (key, number)
+    return _hashed_key(key)
+
+
+def cache_snapshot(name, load, update=None, timeout=None):
+    """
+    Returns the value created by calling ``load``, which is kept in
+    the process until ``bump_cache_version`` is called with the given
+    name by any process. Used for small, frequently read tables of
+    data, where each lookup would otherwise be a round trip to the
+    database or cache backend. The value is also stored on the
+    current request, so that its version is only checked once per
+    request. Without Mezzanine's cache middleware installed, the
+    value is loaded once per request.
+
+    If ``update`` is given, changes recorded for the name with
+    ``cache_snapshot_change`` are applied to the value in place by
+    calling ``update`` with the value and the list of changes, rather
+    than the value being loaded again. The timeout, which can be a
+    callable that's only called when the value is loaded, gives the
+    number of seconds until the value is loaded again regardless.
+    """
+    request = current_request()
+    values = getattr(request, "_cache_snapshots", None)
+    if values is None:
+        values = {}
+        if request is not None:
+            request._cache_snapshots = values
+    try:
+        return values[name]
+    except KeyError:
+        pass
+    if cache_installed():
+        # The version and number of changes are read before loading,
+        # so that a change made while loading is applied afterwards.
+        version_key, count_key = _version_key(name), _changes_key(name)
+        found = cache.get_many([version_key, count_key])
+        version = found.get(version_key)
+        if version is None:
+            version = cache_version(name)
+        count = found.get(count_key)
+        if count is None:
+            count = _changes_count(name)
+        with _snapshots_lock:
+            snapshot = _snapshots.get(name)
+        if (snapshot is None or snapshot[0] != version or
+                (snapshot[2] is not None and time() > snapshot[2])):
+            snapshot = None
+        elif snapshot[3] != count:
+            snapshot = _update_snapshot(name, update, version, count)
+        if snapshot is None:
+            if callable(timeout):
+                timeout = timeout()
+            expires = time() + timeout if timeout is not None else None
+            snapshot = (version, load(), expires, count)
+            with _snapshots_lock:
+                _snapshots[name] = snapshot
+        value = snapshot[1]
+    else:
+        value = load()
+    values[name] = value
+    return value
+
+
+def _update_snapshot(name, update, version, count):
+    """
+    Applies the changes recorded since the process' snapshot for the
+    name was loaded or last updated, up to the given count. Returns
+    ``None`` if the snapshot needs to be loaded again instead. The
+    lock is held throughout, so that changes are applied in order.
+    """
+    with _snapshots_lock:
+        snapshot = _snapshots.get(name)
+        if snapshot is None or snapshot[0] != version:
+            return None
+        applied = snapshot[3]
+        if applied == count:
+            return snapshot
+        if (update is None or applied > count or
+                count - applied > MAX_SNAPSHOT_CHANGES):
+            return None
+        keys = [_changes_key(name, n) for n in range(applied + 1, count + 1)]
+        found = cache.get_many(keys)
+        if len(found) < len(keys):
+            return None
+        update(snapshot[1], [found[key] for key in keys])
+        snapshot = snapshot[:3] + (count,)
+        _snapshots[name] = snapshot
+        return snapshot
+
+
+def _changes_count(name):
+    """
+    Returns the number of the last change recorded for the name by
+    ``cache_snapshot_change``. A missing count is created from the
+    current time in milliseconds, so that if it's been evicted, the
+    new count is always too far ahead of the count applied by each
+    process for the changes to be applied, and the value is loaded
+    again instead.
+    """
+    count_key = _changes_key(name)
+    cache.add(count_key, int(time() * 1000), VERSION_TIMEOUT)
+    return cache.get(count_key, 0)
+
+
+def cache_snapshot_change(name, change):
+    """
+    Records a change to the value kept by ``cache_snapshot`` for the
+    name, which each process applies to its value in place with the
+    ``update`` callable given to ``cache_snapshot``.
+    """
+    _changes_count(name)
+    try:
+        count = cache.incr(_changes_key(name))
+    except ValueError:
+        # Evicted since it was created.
+        bump_cache_version(name)
+    else:
+        cache.set(_changes_key(name, count), change, SNAPSHOT_CHANGE_TIMEOUT)
+
+
 def cache_installed():
     """
     Returns ``True`` if a cache backend is configured, and the
@@ -78,6 +428,86 @@ def cache_key_prefix(request):
     return _i18n_cache_key_suffix(request, cache_key)
 
 
+def _ignored_param(name):
+    """
+    Returns ``True`` if the querystring parameter name matches one of
+    the patterns in the ``CACHE_KEY_IGNORED_PARAMS`` setting, which
+    are compiled into a single regex the first time they're used.
+    """
+    global _ignored_params
+    patterns, regex = _ignored_params
+    if patterns != settings.CACHE_KEY_IGNORED_PARAMS:
+        patterns = settings.CACHE_KEY_IGNORED_PARAMS
+        regex = re.compile("|".join([translate(p) for p in patterns]))
+        _ignored_params = (patterns, regex)
+    return bool(patterns) and regex.match(name) is not None
+
+
+def cache_key_path(request):
+    """
+    Returns the request's path and normalised querystring, used with
+    ``cache_key_prefix`` as the key for Mezzanine's cache middleware.
+    Parameters matching the ``CACHE_KEY_IGNORED_PARAMS`` setting are
+    removed, values for the ``CACHE_KEY_LOWERCASE_PARAMS`` setting
+    are lowercased, and the remaining parameters are sorted, so that
+    equivalent URLs share a single cache entry.
+    """
+    query = []
+    lowercase = settings.CACHE_KEY_LOWERCASE_PARAMS
+    querystring = request.META.get("QUERY_STRING", "")
+    for (name, value) in parse_qsl(querystring, keep_blank_values=True):
+        if not _ignored_param(name):
+            if name in lowercase:
+                value = value.lower()
+            query.append((name, value))
+    if not query:
+        return request.path
+    query.sort()
+    return "%s?%s" % (request.path, urlencode(query))
+
+
+def _stats_key(name):
+    return _hashed_key("%s.stats.%s" %
+                       (settings.CACHE_MIDDLEWARE_KEY_PREFIX, name))
+
+
+def cache_stat(name):
+    """
+    Increments the named counter in the cache middleware's
+    statistics. Counters are kept in the process and periodically
+    added to the totals in the cache backend, which are shared by all
+    processes and returned by ``cache_stats``.
+    """
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + 1
+        if sum(_stats.values()) < STATS_FLUSH_COUNT:
+            return
+        counts = _stats.items()
+        _stats.clear()
+    for (name, count) in counts:
+        key = _stats_key(name)
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            if not cache.add(key, count, VERSION_TIMEOUT):
+                cache.incr(key, count)
+
+
+def cache_stats():
+    """
+    Returns the totals for the cache middleware's statistics shared
+    by all processes, along with the hit rate.
+    """
+    names = ("hits", "misses", "invalidations", "bypasses")
+    keys = dict([(_stats_key(name), name) for name in names])
+    stats = dict([(name, 0) for name in names])
+    for (key, count) in cache.get_many(keys.keys()).items():
+        stats[keys[key]] = count
+    lookups = stats["hits"] + stats["misses"] + stats["invalidations"]
+    stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0
+    return stats
+
+
 def nevercache_token():
     """
     Returns the secret token that delimits content wrapped in
@@ -86,6 +516,65 @@ def nevercache_token():
     return "nevercache." + settings.SECRET_KEY
 
 
+def nevercache_parts(content, token=None):
+    """
+    Scans content once for the ``nevercache`` token, returning the
+    parts it delimits, where odd parts are template code to render.
+    Returns ``None`` without building any list when the token isn't
+    found, which is the case for most responses.
+    """
+    if token is None:
+        token = nevercache_token()
+    end = content.find(token)
+    if end == -1:
+        return None
+    parts = []
+    start = 0
+    token_length = len(token)
+    while end != -1:
+        parts.append(content[start:end])
+        start = end + token_length
+        end = content.find(token, start)
+    parts.append(content[start:])
+    return parts
+
+
+class LRUCache(object):
+    """
+    Process-local, thread-safe mapping that holds at most
+    ``max_size`` entries, discarding the least recently used entry
+    when full.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 def add_cache_bypass(url):
     """
     Adds the current time to the querystring of the URL to force a
@@ -100,4 +589,133 @@ def add_cache_bypass(url):
         url, hash_str = url.split("#", 1)
         hash_str = "#" + hash_str
     url += "?" if "?" not in url else "&"
-    return url + "t=" + str(time()).replace(".", "") + hash_str
+    bypass = "%s=%s" % (CACHE_BYPASS_PARAM, str(time()).replace(".", ""))
+    return url + bypass + hash_str
+
+
+def _tag_models():
+    """
+    Returns the models whose instances are used to tag the responses
+    cached by Mezzanine's cache middleware - ``Displayable``
+    subclasses and the models defined by the ``CACHE_TAG_MODELS``
+    setting.
+    """
+    global _tag_models_cache
+    if _tag_models_cache is None:
+        from django.db.models import get_model
+        from mezzanine.core.models import Displayable
+        models = [get_model(*name.split(".", 1))
+                  for name in settings.CACHE_TAG_MODELS]
+        models = [Displayable] + [m for m in models if m is not None]
+        _tag_models_cache = tuple(models)
+    return _tag_models_cache
+
+
+def cache_tag_label(instance):
+    """
+    Returns the model level tag for the instance or model, or ``None``
+    if its model isn't tagged. The super-most tagged model is used, so
+    that eg a ``RichTextPage`` and the ``Page`` it's loaded as share
+    tags.
+    """
+    from mezzanine.core.models import Displayable
+    cls = instance if isinstance(instance, type) else instance.__class__
+    for model in _tag_models():
+        if issubclass(cls, model):
+            if model is Displayable:
+                model = [m for m in cls.__mro__ if issubclass(m, model)
+                         and not m._meta.abstract][-1]
+            opts = model._meta
+            return "tag.%s.%s" % (opts.app_label, opts.object_name.lower())
+    return None
+
+
+def _tag_state(instance):
+    """
+    Fields of a ``Displayable`` that determine whether it appears in
+    listings, so a change to them invalidates the model level tag.
+    """
+    return tuple([getattr(instance, name, None) for name in
+                  ("status", "publish_date", "expiry_date")])
+
+
+def cache_tag_loaded(sender, instance, **kwargs):
+    """
+    ``post_init`` handler that adds tags for each model instance
+    loaded while rendering a response that ``UpdateCacheMiddleware``
+    will store, so that the cache entry can be invalidated when any
+    of those instances change. The versions of the model level tags
+    are read when the first instance of each model is loaded, so that
+    ``cache_tag_versions`` can tell if the model changed while the
+    response was being rendered. Only connected when Mezzanine's
+    cache middleware is installed.
+    """
+    if instance.pk is None:
+        return
+    label = cache_tag_label(instance)
+    if label is None:
+        return
+    instance._cache_tag_state = _tag_state(instance)
+    request = current_request()
+    if request is not None and getattr(request, "_update_cache", False):
+        tags = request.__dict__.setdefault("_cache_tags", {})
+        if label not in tags:
+            versions = request.__dict__.setdefault("_cache_tag_versions", {})
+            versions.update(cache_versions([label, "%s.*" % label]))
+        tags.setdefault(label, set()).add(instance.pk)
+
+
+def cache_tags_for_request(request):
+    """
+    Returns the tags collected by ``cache_tag_loaded`` for the
+    request. Each model tag is only invalidated when instances are
+    added, removed, published or unpublished. If too many instances
+    were loaded, a model tag that's invalidated on every change is
+    used in place of the instance tags.
+    """
+    tags = getattr(request, "_cache_tags", {})
+    labels = tags.keys()
+    if sum([len(pks) for pks in tags.values()]) > MAX_INSTANCE_TAGS:
+        return labels + ["%s.*" % label for label in labels]
+    for (label, pks) in tags.items():
+        labels.extend(["%s.%s" % (label, pk) for pk in pks])
+    return labels
+
+
+def cache_tag_versions(request):
+    """
+    Returns the versions of the tags collected by
+    ``cache_tag_loaded`` for the request, to store with its response.
+    Every save or delete bumps the ``label.*`` tag for the model, so
+    if the model level versions read when its first instance was
+    loaded have since changed, an instance may have changed while the
+    response was being rendered. ``None`` is returned in that case,
+    since the response may already be stale and shouldn't be stored.
+    """
+    tags = cache_tags_for_request(request)
+    loaded = getattr(request, "_cache_tag_versions", {})
+    versions = cache_versions(set(tags) | set(loaded))
+    for (name, version) in loaded.items():
+        if versions[name] != version:
+            return None
+    return dict([(tag, versions[tag]) for tag in tags])
+
+
+def cache_tag_changed(sender, instance, created=False, **kwargs):
+    """
+    ``post_save`` and ``post_delete`` handler that invalidates the
+    cached responses tagged with the instance.
+    """
+    if not cache_installed():
+        return
+    label = cache_tag_label(instance)
+    if label is None or instance.pk is None:
+        return
+    tags = ["%s.%s" % (label, instance.pk), "%s.*" % label]
+    state = _tag_state(instance)
+    deleted = kwargs.get("signal") is post_delete
+    previous = getattr(instance, "_cache_tag_state", None)
+    if created or deleted or previous != state:
+        tags.append(label)
+    instance._cache_tag_state = state
+    bump_cache_version(*tags)
@@ -1,30 +1,76 @@
 
+import re
+
+
+# Number of user agent strings whose matched device is stored by
+# ``device_from_user_agent``.
+USER_AGENT_CACHE_SIZE = 1000
+
+_user_agents = (None, None, None)
+
+
+def device_from_user_agent(user_agent):
+    """
+    Returns the device name whose ``DEVICE_USER_AGENTS`` strings
+    are first found in the given user agent. The strings for each
+    device are compiled into a single regex, and the device matched
+    for each user agent is stored in a bounded LRU cache, since most
+    requests come from a small number of distinct user agents.
+    """
+    global _user_agents
+    from mezzanine.conf import settings
+    device_user_agents, regexes, devices = _user_agents
+    if device_user_agents != settings.DEVICE_USER_AGENTS:
+        from mezzanine.utils.cache import LRUCache
+        device_user_agents = settings.DEVICE_USER_AGENTS
+        regexes = [(device, re.compile("|".join([re.escape(s.lower())
+                                                 for s in ua_strings])))
+                   for (device, ua_strings) in device_user_agents
+                   if ua_strings]
+        devices = LRUCache(USER_AGENT_CACHE_SIZE)
+        _user_agents = (device_user_agents, regexes, devices)
+    device = devices.get(user_agent)
+    if device is None:
+        device = ""
+        lowered = user_agent.lower()
+        for (name, regex) in regexes:
+            if regex.search(lowered):
+                device = name
+                break
+        devices.set(user_agent, device)
+    return device
+
 
 def device_from_request(request):
     """
     Determine's the device name from the request by first looking for an
     overridding cookie, and if not found then matching the user agent.
     Used at both the template level for choosing the template to load and
-    also at the cache level as a cache key prefix.
+    also at the cache level as a cache key prefix. The device is
+    stored on the request, since it's looked up several times during
+    each request.
     """
+    try:
+        return request._device
+    except AttributeError:
+        pass
     from mezzanine.conf import settings
+    device = ""
     try:
         # If a device was set via cookie, match available devices.
-        for (device, _) in settings.DEVICE_USER_AGENTS:
-            if device == request.COOKIES["mezzanine-device"]:
-                return device
+        cookie = request.COOKIES["mezzanine-device"]
     except KeyError:
         # If a device wasn't set via cookie, match user agent.
-        try:
-            user_agent = request.META["HTTP_USER_AGENT"].lower()
-        except KeyError:
-            pass
-        else:
-            for (device, ua_strings) in settings.DEVICE_USER_AGENTS:
-                for ua_string in ua_strings:
-                    if ua_string.lower() in user_agent:
-                        return device
-    return ""
+        user_agent = request.META.get("HTTP_USER_AGENT")
+        if user_agent is not None:
+            device = device_from_user_agent(user_agent)
+    else:
+        for (name, _) in settings.DEVICE_USER_AGENTS:
+            if name == cookie:
+                device = name
+                break
+    request._device = device
+    return device
 
 
 def templates_for_device(request, templates):
@@ -8,6 +8,10 @@ from mezzanine.conf import settings
 from mezzanine.core.request import current_request
 
 
+# Name of the cached version for the domain to site ID mapping.
+SITE_IDS = "site_ids"
+
+
 def current_site_id():
     """
     Responsible for determining the current ``Site`` instance to use
@@ -25,37 +29,86 @@ def current_site_id():
         site.
       - ``SITE_ID`` setting.
 
+    Domains are matched against a mapping of all sites held in the
+    process.
     """
-    from mezzanine.utils.cache import cache_installed, cache_get, cache_set
+    from mezzanine.utils.cache import cache_snapshot
     request = current_request()
     site_id = getattr(request, "site_id", None)
     if request and not site_id:
         site_id = request.session.get("site_id", None)
         if not site_id:
             domain = request.get_host().lower()
-            if cache_installed():
-                # Don't use Mezzanine's cache_key_prefix here, since it
-                # uses this very function we're in right now to create a
-                # per-site cache key.
-                bits = (settings.CACHE_MIDDLEWARE_KEY_PREFIX, domain)
-                cache_key = "%s.site_id.%s" % bits
-                site_id = cache_get(cache_key)
-            if not site_id:
-                try:
-                    site = Site.objects.get(domain__iexact=domain)
-                except Site.DoesNotExist:
-                    pass
-                else:
-                    site_id = site.id
-                    if cache_installed():
-                        cache_set(cache_key, site_id)
-        if request and site_id:
+            site_id = cache_snapshot(SITE_IDS, site_ids_by_domain).get(domain)
+        if site_id:
             request.site_id = site_id
     if not site_id:
         site_id = os.environ.get("MEZZANINE_SITE_ID", settings.SITE_ID)
     return site_id
 
 
+def site_ids_by_domain():
+    """
+    Returns a dict mapping each lowercase site domain to its site ID,
+    which ``current_site_id`` keeps in the process via
+    ``cache_snapshot`` until ``site_changed`` is called.
+    """
+    sites = Site.objects.values_list("domain", "id")
+    return dict([(domain.lower(), site_id) for (domain, site_id) in sites])
+
+
+def site_changed(**kwargs):
+    """
+    Signal handler for ``Site`` being saved or deleted, that expires
+    the domain to site ID mapping in every process.
+    """
+    from mezzanine.utils.cache import bump_cache_version
+    bump_cache_version(SITE_IDS)
+
+
+def user_site_ids(user):
+    """
+    Returns the set of IDs for the sites that a staff user has been
+    given access to via ``SitePermission``. With Mezzanine's cache
+    middleware installed, the IDs are stored in the cache backend
+    until ``site_permission_changed`` is called for the user.
+    """
+    from mezzanine.utils.cache import cache_installed, cache_versioned
+    sites = Site.objects.filter(sitepermission__user=user)
+    load = lambda: set(sites.values_list("id", flat=True))
+    if not cache_installed():
+        return load()
+    return cache_versioned("site_permissions.%s" % user.id, load)
+
+
+def site_permission_changed(sender, instance, **kwargs):
+    """
+    Signal handler for ``SitePermission`` being saved or deleted, or
+    its sites changing from either side of the relationship, that
+    expires the site IDs stored by ``user_site_ids`` for its user.
+    """
+    from mezzanine.core.models import SitePermission
+    from mezzanine.utils.cache import bump_cache_version
+    action = kwargs.get("action")
+    if isinstance(instance, SitePermission):
+        if action in ("pre_add", "pre_remove", "pre_clear"):
+            return
+        user_ids = [instance.user_id]
+    elif action == "pre_clear":
+        # Sites losing all their permissions, which are no longer
+        # known once cleared.
+        perms = SitePermission.objects.filter(sites=instance)
+        user_ids = perms.values_list("user_id", flat=True)
+    elif action in ("post_add", "post_remove"):
+        perms = SitePermission.objects.filter(id__in=kwargs["pk_set"])
+        user_ids = perms.values_list("user_id", flat=True)
+    else:
+        return
+    names = ["site_permissions.%s" % user_id for user_id in user_ids]
+    if names:
+        bump_cache_version(*names)
+
+
 def has_site_permission(user):
     """
     Checks if a staff user has staff-level access for the current site.
@@ -105,3 +105,77 @@ def path_to_slug(path):
         if prefix:
             path = path.replace(prefix, "", 1)
     return path.strip("/") or "/"
+
+
+class RedirectTable(object):
+    """
+    Redirects for a single site, given as a sequence of old and new
+    path pairs. Old paths ending in ``*`` redirect every path that
+    starts with them, and are held in a trie of nested dicts keyed by
+    each character, so that the longest matching prefix is found in
+    a single pass over the path. All other paths are held in a dict.
+    """
+
+    def __init__(self, redirects):
+        self.paths = {}
+        self.prefixes = {}
+        for (old_path, new_path) in redirects:
+            if old_path.endswith("*"):
+                node = self.prefixes
+                for char in old_path[:-1]:
+                    node = node.setdefault(char, {})
+                node[None] = new_path
+            else:
+                self.paths[old_path] = new_path
+
+    def get(self, path):
+        """
+        Returns the new path to redirect the given path to, which is
+        empty for paths that are gone, or ``None`` if the path has no
+        redirect. Exact paths take precedence over prefixes.
+        """
+        try:
+            return self.paths[path]
+        except KeyError:
+            pass
+        node = self.prefixes
+        new_path = node.get(None)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            new_path = node.get(None, new_path)
+        return new_path
+
+
+def redirect_for_path(site_id, path):
+    """
+    Returns the new path that ``Redirect`` instances for the site
+    define for the given path - see ``RedirectTable.get``. With
+    Mezzanine's cache middleware installed, each site's redirects are
+    held in the process until ``redirect_changed`` is called for the
+    site, so that looking up a path never queries the database.
+    """
+    from django.contrib.redirects.models import Redirect
+    from django.db.models import Q
+    from mezzanine.utils.cache import cache_installed, cache_snapshot
+    redirects = Redirect.objects.filter(site=site_id)
+    if cache_installed():
+        load = lambda: RedirectTable(redirects.values_list("old_path",
+                                                           "new_path"))
+        table = cache_snapshot("redirects.%s" % site_id, load)
+    else:
+        redirects = redirects.filter(Q(old_path=path) |
+                                     Q(old_path__endswith="*"))
+        table = RedirectTable(redirects.values_list("old_path", "new_path"))
+    return table.get(path)
+
+
+def redirect_changed(sender, instance, **kwargs):
+    """
+    Signal handler for ``Redirect`` being saved or deleted, that
+    expires its site's redirects held by ``redirect_for_path`` in
+    every process.
+    """
+    from mezzanine.utils.cache import bump_cache_version
+    bump_cache_version("redirects.%s" % instance.site_id)
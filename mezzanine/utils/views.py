@@ -1,14 +1,20 @@
 
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
 from urllib import urlencode
 from urllib2 import Request, urlopen
 
 import django
+from django.core import signing
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.db import connection
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.forms import EmailField, URLField, Textarea
 from django.template import RequestContext
 from django.template.response import TemplateResponse
+from django.utils import simplejson
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import ugettext as _
 
 import mezzanine
@@ -117,12 +123,38 @@ def is_spam(request, form, url):
             return True
 
 
-def paginate(objects, page_num, per_page, max_paging_links):
+def paginate(objects, page_num, per_page, max_paging_links,
+             count_key=None, count_tags=None):
     """
     Return a paginated page for the given objects, giving it a custom
     ``visible_page_range`` attribute calculated from ``max_paging_links``.
+
+    If ``count_key`` is given, the total count of the objects is
+    stored in the cache backend under the key for the current site,
+    until any of ``count_tags`` are invalidated. These default to the
+    tag for the model being added, removed, published or unpublished,
+    which can also be invalidated for other changes that affect which
+    objects are listed, such as their categories. The count is also
+    only stored until the next publish or expiry date of any of the
+    objects, since these change which objects are published without
+    the tags being invalidated.
     """
     paginator = Paginator(objects, per_page)
+    if count_key is not None:
+        from mezzanine.utils.cache import cache_installed, cache_tag_label
+        from mezzanine.utils.cache import cache_tagged, publish_cache_timeout
+        from mezzanine.utils.sites import current_site_id
+        if cache_installed():
+            if count_tags is None:
+                count_tags = [cache_tag_label(objects.model)]
+            tags = [tag for tag in count_tags if tag is not None]
+            key = "%s.count.%s.%s" % (settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+                                      current_site_id(), count_key)
+            load = lambda: paginator.count
+            timeout = lambda: publish_cache_timeout(objects.model)
+            # Stored against the paginator, so that it doesn't count
+            # the objects again.
+            paginator._count = cache_tagged(key, tags, load, timeout)
     try:
         page_num = int(page_num)
     except ValueError:
@@ -140,6 +172,257 @@ def paginate(objects, page_num, per_page, max_paging_links):
     return objects
 
 
+def approximate_count(objects):
+    """
+    Returns the number of objects in the given queryset, which is
+    stored in the cache backend for ``CACHE_MIDDLEWARE_SECONDS`` when
+    Mezzanine's cache middleware is installed, so may be out of date.
+    """
+    from mezzanine.utils.cache import cache_get, cache_installed, cache_set
+    if not cache_installed():
+        return objects.count()
+    try:
+        query = unicode(objects.query)
+    except EmptyResultSet:
+        # Raised when the query can't match anything, such as for a
+        # lookup in an empty list, so there's no SQL to key it on.
+        return 0
+    key = "%s.count.%s" % (settings.CACHE_MIDDLEWARE_KEY_PREFIX, query)
+    count = cache_get(key)
+    if count is None:
+        count = objects.count()
+        cache_set(key, count)
+    return count
+
+
+class CursorSerializer(object):
+    """
+    JSON serializer for the sort values stored in keyset pagination
+    cursors. Dates, datetimes and decimals are stored as strings in a
+    dict with their type, so that they're loaded as the same type.
+    """
+
+    types = {
+        "date": (date, parse_date),
+        "datetime": (datetime, parse_datetime),
+        "decimal": (Decimal, Decimal),
+    }
+
+    def encode(self, obj):
+        # Datetimes are checked before dates, since they subclass date.
+        for name in ("datetime", "date", "decimal"):
+            if isinstance(obj, self.types[name][0]):
+                value = obj if name == "decimal" else obj.isoformat()
+                return {"type": name, "value": unicode(value)}
+        raise TypeError("%r is not JSON serializable" % obj)
+
+    def decode(self, obj):
+        if set(obj) == set(("type", "value")) and obj["type"] in self.types:
+            return self.types[obj["type"]][1](obj["value"])
+        return obj
+
+    def dumps(self, obj):
+        return simplejson.dumps(obj, separators=(",", ":"),
+                                default=self.encode)
+
+    def loads(self, data):
+        return simplejson.loads(data, object_hook=self.decode)
+
+
+class KeysetPaginator(object):
+    """
+    Stands in for Django's ``Paginator`` on a ``KeysetPage``, with the
+    number of pages derived from an approximate count.
+    """
+
+    def __init__(self, count, per_page):
+        self.count = count
+        self.per_page = per_page
+        self.num_pages = max(1, (count + per_page - 1) // per_page)
+        self.page_range = range(1, self.num_pages + 1)
+
+
+class KeysetPage(object):
+    """
+    Page of objects returned by ``paginate_keyset``, with the same
+    interface as Django's ``Page`` used by the pagination template,
+    except that the next and previous page "numbers" are cursors, and
+    ``page_var`` gives the querystring param for them. The previous
+    cursor is only queried for when used.
+    """
+
+    page_var = "cursor"
+
+    def __init__(self, object_list, number, paginator, next_cursor,
+                 previous_cursor):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self._previous_cursor = previous_cursor
+        self.visible_page_range = []
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.next_cursor
+
+    def previous_page_number(self):
+        if callable(self._previous_cursor):
+            self._previous_cursor = self._previous_cursor()
+        return self._previous_cursor
+
+
+def _keyset_columns(objects, ordering):
+    """
+    Returns the SQL expression, its params, the attribute name on
+    each object, and whether it's descending, for each field name in
+    the ordering, which can be model fields on the queryset's model
+    or names of its ``extra`` selects.
+    """
+    qn = connection.ops.quote_name
+    opts = objects.model._meta
+    columns = []
+    for name in ordering:
+        descending = name.startswith("-")
+        name = name.lstrip("-")
+        if name in objects.query.extra:
+            sql, params = objects.query.extra[name]
+            columns.append(("(%s)" % sql, list(params), name, descending))
+            continue
+        field = opts.pk if name == "pk" else opts.get_field(name)
+        table = field.model._meta.db_table
+        sql = "%s.%s" % (qn(table), qn(field.column))
+        columns.append((sql, [], field.attname, descending))
+    return columns
+
+
+def _keyset_filter(objects, columns, values):
+    """
+    Filters the queryset to the objects that come after the given
+    sort values in the order given by the columns.
+    """
+    clauses = []
+    params = []
+    for (i, (sql, sql_params, attname, descending)) in enumerate(columns):
+        parts = []
+        for (j, prior) in enumerate(columns[:i]):
+            parts.append("%s = %%s" % prior[0])
+            params.extend(prior[1] + [values[j]])
+        parts.append("%s %s %%s" % (sql, "<" if descending else ">"))
+        params.extend(sql_params + [values[i]])
+        clauses.append("(%s)" % " AND ".join(parts))
+    return objects.extra(where=["(%s)" % " OR ".join(clauses)],
+                         params=params)
+
+
+def _keyset_ordering(objects, columns):
+    """
+    Returns the names to order the queryset by for the columns. Model
+    fields are ordered by their column, since ordering by a model's
+    primary key when it inherits from another model would otherwise
+    order by the parent model's default ordering.
+    """
+    ordering = []
+    for (sql, params, attname, descending) in columns:
+        name = attname if attname in objects.query.extra else sql
+        ordering.append("%s%s" % ("-" if descending else "", name))
+    return ordering
+
+
+def paginate_keyset(objects, cursor, per_page, ordering=None, count=True):
+    """
+    Alternative to ``paginate`` for large querysets, that returns a
+    ``KeysetPage`` for the page following the object encoded in the
+    given cursor, which is empty for the first page. Rather than
+    counting every object and using an offset into them, the page is
+    selected by filtering on the sort values of the last object on the
+    previous page, and the total count used for the number of pages is
+    given by ``approximate_count``. The ordering defaults to the
+    queryset's, and has the primary key added so that each object has
+    a distinct position. Ordering on fields of related models isn't
+    supported. Cursors are signed with the columns they were created
+    for, so a cursor from a listing with a different ordering is
+    treated as the first page. If ``count`` is ``False``, the objects
+    aren't counted and the page has no paginator.
+    """
+    if ordering is None:
+        ordering = (objects.query.extra_order_by or
+                    objects.query.order_by or
+                    objects.model._meta.ordering)
+    ordering = list(ordering)
+    pk_names = (objects.model._meta.pk.name, "pk")
+    if not [name for name in ordering if name.lstrip("-") in pk_names]:
+        descending = ordering and ordering[-1].startswith("-")
+        ordering.append("-pk" if descending else "pk")
+    columns = _keyset_columns(objects, ordering)
+    objects = objects.extra(order_by=_keyset_ordering(objects, columns))
+    serializer = CursorSerializer
+    salt = "mezzanine.utils.views.paginate_keyset.%s" % "".join(
+        ["%s%s%s" % (sql, params, descending)
+         for (sql, params, attname, descending) in columns])
+    try:
+        number, values = signing.loads(cursor, salt=salt,
+                                       serializer=serializer)
+    except (signing.BadSignature, TypeError, ValueError):
+        number, values = 1, None
+    else:
+        if values is not None and len(values) != len(columns):
+            number, values = 1, None
+    following = objects
+    if values is not None:
+        following = _keyset_filter(objects, columns, values)
+    object_list = list(following[:per_page + 1])
+    next_cursor = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        last = [getattr(object_list[-1], c[2]) for c in columns]
+        next_cursor = signing.dumps((number + 1, last), salt=salt,
+                                    serializer=serializer)
+
+    def previous_cursor():
+        # The page before the previous page ends with the object that
+        # comes ``per_page`` objects before the first on this page,
+        # which is found by reversing the ordering.
+        if number <= 2 or not object_list:
+            return ""
+        first = [getattr(object_list[0], c[2]) for c in columns]
+        reverse = [(sql, params, attname, not descending)
+                   for (sql, params, attname, descending) in columns]
+        preceding = _keyset_filter(objects, reverse, first)
+        preceding = preceding.extra(order_by=_keyset_ordering(objects,
+                                                              reverse))
+        try:
+            before = preceding[per_page]
+        except IndexError:
+            return ""
+        last = [getattr(before, c[2]) for c in columns]
+        return signing.dumps((number - 1, last), salt=salt,
+                             serializer=serializer)
+
+    paginator = None
+    if count:
+        paginator = KeysetPaginator(approximate_count(objects), per_page)
+    return KeysetPage(object_list, number, paginator, next_cursor,
+                      previous_cursor)
+
+
 def render(request, templates, dictionary=None, context_instance=None,
            **kwargs):
     """